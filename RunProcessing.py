@@ -43,6 +43,11 @@ if __name__ == "__main__":
     for f in failed:
         print(" - ", f)
 
+    print('-------------------')
+    print("Skipped:")
+    for s in processor.skipped:
+        print(" - ", s)
+
     print('-------------------')
     print("Succesfully generated files for:")
     for s in successful:
@@ -1,5 +1,6 @@
 import os
 import re
+import shutil
 import zipfile  # for extractall, ZipFile, BadZipFile
 
 from datetime import date
@@ -24,10 +25,13 @@ def path_exists(path: str) -> bool:
         print(f"Invalid Path: {path}")
         return False
     
-def asf_unzip(output_dir: str, file_path: str):
+def asf_unzip(output_dir: str, file_path: str, suffixes: tuple | None = None):
     """
     Takes an output directory path and a file path to a zipped archive.
     If file is a valid zip, it extracts all to the output directory.
+    If suffixes are given, only the members named <product><suffix> for
+    one of them are extracted (e.g. S1AA_..._unw_phase.tif in directory
+    S1AA_...), streaming each one straight to its destination.
     """
     ext = os.path.splitext(file_path)[1]
     assert type(output_dir) == str, 'Error: output_dir must be a string'
@@ -38,7 +42,24 @@ def asf_unzip(output_dir: str, file_path: str):
         if path_exists(file_path):
             print(f"Extracting: {file_path}")
             try:
-                zipfile.ZipFile(file_path).extractall(output_dir)
+                with zipfile.ZipFile(file_path) as zf:
+                    if suffixes is None:
+                        zf.extractall(output_dir)
+                        return
+
+                    for member in zf.infolist():
+                        if member.is_dir():
+                            continue
+                        product, _, name = member.filename.rpartition('/')
+                        product = os.path.basename(product)
+                        if not name.startswith(product) or name[len(product):] not in suffixes:
+                            continue
+                        dest = os.path.normpath(os.path.join(output_dir, member.filename))
+                        if not dest.startswith(os.path.normpath(output_dir) + os.sep):
+                            continue  # don't write outside of output_dir
+                        os.makedirs(os.path.dirname(dest), exist_ok=True)
+                        with zf.open(member) as src, open(dest, 'wb') as dst:
+                            shutil.copyfileobj(src, dst, 1024 * 1024)
             except zipfile.BadZipFile:
                 print(f"Zipfile Error.")
             return
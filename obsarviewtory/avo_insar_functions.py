@@ -17,18 +17,69 @@ import asf_search as asf
 
 import hyp3_sdk as sdk
 
+try:
+    import baseline_cache
+    import network as network_design
+    from downloader import Downloader
+    from footprints import aoi_bounds, bounds_intersect
+    from retry import retry_call
+except ImportError:
+    from . import baseline_cache
+    from . import network as network_design
+    from .downloader import Downloader
+    from .footprints import aoi_bounds, bounds_intersect
+    from .retry import retry_call
+
+
+# the members of each HyP3 zip used by the pipeline; nothing else is extracted.
+# '.txt' is the product metadata, which MintPy reads next to each raster.
+PRODUCT_SUFFIXES = (
+    '_unw_phase.tif', '_corr.tif', '_dem.tif', '_lv_theta.tif', '_lv_phi.tif',
+    '_water_mask.tif', '_color_phase.kmz', '.txt',
+)
+
+# the geometry layers; the same for every job of a project, so they are cropped once per
+# volcano into its geometry cache rather than from every product
+GEOMETRY_SUFFIXES = ('_dem.tif', '_lv_theta.tif', '_lv_phi.tif', '_water_mask.tif')
 
-def avo_insar_download( hyp3: sdk.HyP3, asf_name: str , analysis_directory: Path):
+# the products staged into each volcano's analysis directory for cropping and MintPy
+STAGE_SUFFIXES = ('_unw_phase.tif', '_corr.tif', '.txt')
+
+
+def avo_insar_download( hyp3: sdk.HyP3, asf_name: str , analysis_directory: Path, jobs: sdk.Batch | None = None,
+                        downloader: Downloader | None = None):
 # download project {asf_name} into {analysis_directory}
-    jobs = hyp3.find_jobs(name=asf_name)
+# if {jobs} is given, only those jobs are downloaded. Returns the list of jobs downloaded.
+# jobs are downloaded concurrently by {downloader}, which may be shared between projects;
+# each job is unzipped on its download worker as soon as its download completes, while
+# other jobs are still downloading.
+    if jobs is None:
+        jobs = hyp3.find_jobs(name=asf_name)
     if not jobs:
         return []
 
-    print(f"\nProject: {jobs.jobs[0].name}")
-    project_zips = jobs.download_files(analysis_directory) # download
-    for z in project_zips:
-        asfn.asf_unzip(str(analysis_directory), str(z)) # unzip
-        z.unlink()
+    if downloader is None:
+        with Downloader() as downloader:
+            return avo_insar_download(hyp3, asf_name, analysis_directory, jobs, downloader)
+
+    def extract(job, job_zips):
+        for z in job_zips:
+            # only the members used for processing are written
+            asfn.asf_unzip(str(analysis_directory), str(z), PRODUCT_SUFFIXES) # unzip
+            z.unlink()
+        product_dir = analysis_directory / Path(job.files[0]['filename']).stem
+        if not product_dir.is_dir():
+            raise IOError(f"nothing extracted for {product_dir.name}")
+        return job_zips
+
+    print(f"\nProject: {asf_name}, downloading {len(jobs)} jobs")
+    downloaded = []
+    for job, result in downloader.download_jobs(jobs, analysis_directory, extract): # download
+        if isinstance(result, Exception):
+            # Leave it for the next run rather than failing the whole project
+            print(f"Unable to download job {job.job_id} of {asf_name}: {result}")
+            continue
+        downloaded.append(job)
 
     # Bad dates are removed when copying the downloaded files into the 
     # working directory.
@@ -37,23 +88,69 @@ def avo_insar_download( hyp3: sdk.HyP3, asf_name: str , analysis_directory: Path
             # remove_date = analysis_directory / filter_date
             # shutil.rmtree(remove_date, ignore_errors = True) #Don't get hung up if we can't remove something
 
-    for pattern in ["xml","png","md.txt"]:
-        unneeded_files = analysis_directory.glob(f"S1*/*.{pattern}") # remove files not needed for processing
-        for file in unneeded_files:
-            file.unlink()
-
-
-def avo_insar_crop( image_file , ul , lr , analysis_directory ):
-# crop downloaded files; these two functions are seperated because I have to run a bash command between them
-    img = gdal.Open(image_file)
-    img.ReadAsArray()
-
+    return downloaded
+
+
+def avo_insar_window( src , ul , lr ):
+# lazily window {src} (a file name or an open gdal dataset) to the aoi; returns an in-memory VRT
+# that only reads the aoi from the source, or None if the aoi lies outside of the raster.
+# the overlap is checked up front: gdal only returns None for it while gdal exceptions are off,
+# and MintPy turns them on for the whole process.
+    if not isinstance(src, gdal.Dataset):
+        src = gdal.Open(str(src))
+        if src is None:
+            return None
+    gt = src.GetGeoTransform()
+    xs = (gt[0], gt[0] + gt[1] * src.RasterXSize)
+    ys = (gt[3], gt[3] + gt[5] * src.RasterYSize)
+    if not bounds_intersect((min(xs), min(ys), max(xs), max(ys)), aoi_bounds(ul, lr)):
+        return None
+    return gdal.Translate('', src, format='VRT', projWin=[ul[0], ul[1], lr[0], lr[1]])
+
+
+def avo_insar_empty( fname ):
+# check if raster {fname} holds no nonzero pixels at all. Uses the cached statistics if there are any,
+# otherwise reads block by block and stops at the first nonzero block, so a valid raster costs
+# close to nothing and a whole band is never held in memory.
+    raster = gdal.Open(str(fname))
+    if not raster:
+        return False
+
+    for b in range(1, raster.RasterCount + 1):
+        band = raster.GetRasterBand(b)
+
+        # cached min/max of the valid pixels; any nonzero means not empty
+        stats_min = band.GetMetadataItem('STATISTICS_MINIMUM')
+        stats_max = band.GetMetadataItem('STATISTICS_MAXIMUM')
+        if stats_min is not None and stats_max is not None:
+            if float(stats_min) != 0 or float(stats_max) != 0:
+                return False
+
+        # read whole blocks, a few at a time for striped rasters
+        bx, by = band.GetBlockSize()
+        by *= max(1, 65536 // (bx * by))
+        for yoff in range(0, band.YSize, by):
+            rows = min(by, band.YSize - yoff)
+            for xoff in range(0, band.XSize, bx):
+                cols = min(bx, band.XSize - xoff)
+                if np.any(band.ReadAsArray(xoff, yoff, cols, rows)):
+                    return False
+
+    return True
+
+
+def avo_insar_crop( ul , lr , analysis_directory ):
+# crop downloaded files to the aoi. Each file is read through a windowed VRT, so only the aoi
+# is ever read from disk; no full scene mosaic is needed.
     fnames = list(analysis_directory.glob('*/*.tif'))
     fnames.sort()
 
     for i, fname in enumerate(fnames):
         clip = fname.parent/f"{fname.stem}_clip.tif"
-        gdal.Translate(destName=str(clip), srcDS=str(fname), projWin=[ul[0], ul[1], lr[0], lr[1]])
+        window = avo_insar_window(fname, ul, lr)
+        if window is not None:
+            gdal.Translate(destName=str(clip), srcDS=window)
+        window = None  # close the vrt
         #gdal.Warp(str(clip), str(clip), dstSRS='EPSG:4326', dstNodata=0)
         fname.unlink()
 
@@ -64,12 +161,9 @@ def avo_insar_crop( image_file , ul , lr , analysis_directory ):
     removed = []
     for f in fnames:
         if not "dem" in str(f):
-            raster = gdal.Open(f)
-            if raster:
-                band = raster.ReadAsArray()
-                if np.count_nonzero(band) < 1:
-                    Path(f).unlink()
-                    removed.append(f)
+            if avo_insar_empty(f):
+                Path(f).unlink()
+                removed.append(f)
     if len(removed) == 0:
         print("No Geotiffs were removed")
     else:
@@ -78,22 +172,51 @@ def avo_insar_crop( image_file , ul , lr , analysis_directory ):
             print(f)
 
 
-def avo_insar_run( analysis_directory , mintpy_directory ): # preparation for running MintPy
-    if not mintpy_directory.is_dir():
-        mintpy_directory.mkdir()
-    mintpy_config = mintpy_directory / 'mintpy_config.txt'
-    mintpy_config.write_text(
+def avo_insar_template( analysis_directory , weather_dir=None , geometry_directory=None , num_workers=None , max_memory=None ): # MintPy config text
+# weather_dir: shared directory of ERA5 data for the tropospheric correction, kept between runs
+# geometry_directory: where the geometry clips are, if not in analysis_directory (the geometry cache)
+# num_workers: cores for MintPy's parallel steps, run on a local Dask cluster if more than one
+# max_memory: the memory, in GB, MintPy splits its processing into blocks of
+    if geometry_directory is None:
+        geometry_directory = analysis_directory
+    template = (
 f"""
 mintpy.load.processor        = hyp3
 ##---------interferogram datasets:
 mintpy.load.unwFile          = {analysis_directory}/*/*_unw_phase_clip.tif
 mintpy.load.corFile          = {analysis_directory}/*/*_corr_clip.tif
 ##---------geometry datasets:
-mintpy.load.demFile          = {analysis_directory}/*/*_dem_clip.tif
-mintpy.load.incAngleFile     = {analysis_directory}/*/*_lv_theta_clip.tif
-mintpy.load.azAngleFile      = {analysis_directory}/*/*_lv_phi_clip.tif
-mintpy.load.waterMaskFile    = {analysis_directory}/*/*_water_mask_clip.tif
+mintpy.load.demFile          = {geometry_directory}/*/*_dem_clip.tif
+mintpy.load.incAngleFile     = {geometry_directory}/*/*_lv_theta_clip.tif
+mintpy.load.azAngleFile      = {geometry_directory}/*/*_lv_phi_clip.tif
+mintpy.load.waterMaskFile    = {geometry_directory}/*/*_water_mask_clip.tif
+""")
+    if weather_dir is not None:
+        template += (
+f"""##---------tropospheric delay correction:
+mintpy.troposphericDelay.method     = pyaps
+mintpy.troposphericDelay.weatherDir = {weather_dir}
 """)
+    if max_memory is not None:
+        template += (
+f"""##---------memory:
+mintpy.compute.maxMemory = {max_memory}
+""")
+    if num_workers is not None and num_workers > 1:
+        template += (
+f"""##---------parallel computing:
+mintpy.compute.cluster   = local
+mintpy.compute.numWorker = {num_workers}
+""")
+    return template
+
+
+def avo_insar_run( analysis_directory , mintpy_directory , weather_dir=None , geometry_directory=None , num_workers=None , max_memory=None ): # preparation for running MintPy
+# writes the config from avo_insar_template into {mintpy_directory}
+    if not mintpy_directory.is_dir():
+        mintpy_directory.mkdir()
+    mintpy_config = mintpy_directory / 'mintpy_config.txt'
+    mintpy_config.write_text(avo_insar_template(analysis_directory, weather_dir, geometry_directory, num_workers, max_memory))
     return mintpy_config
 
 
@@ -135,9 +258,103 @@ def check_project_update( asf_name , record_dates ):
                 return(-1)
 
 
-def update_asf_project( path, frame, asf_name, hyp3):
+def avo_insar_sbas_pairs( stack , max_days=48 ):
+# small baseline pairs of {stack}: every (reference, secondary) whose temporal baseline is more than
+# 0 and at most {max_days} days. Uses the sorted baselines to find each scene's window of secondaries,
+# rather than filtering the whole stack once per scene.
+    order = np.argsort(stack.temporalBaseline.to_numpy(), kind='stable')
+    baselines = stack.temporalBaseline.to_numpy()[order]
+    names = stack.sceneName.to_numpy()[order]
+
+    first = np.searchsorted(baselines, baselines, side='right') # first secondary more than 0 days later
+    last = np.searchsorted(baselines, baselines + max_days, side='right')
+    counts = last - first
+
+    references = np.repeat(np.arange(len(names)), counts)
+    # offsets of each secondary within its reference's window
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    secondaries = np.repeat(first, counts) + offsets
+    return set(zip(names[references], names[secondaries]))
+
+
+def avo_insar_job_pairs( jobs ):
+# (reference, secondary) scene pairs of the jobs of a project, leaving out failed jobs so those may be retried
+    pairs = set()
+    for job in jobs:
+        granules = job.job_parameters.get('granules', []) if job.job_parameters else []
+        if len(granules) == 2 and not job.failed():
+            pairs.add(tuple(granules))
+    return pairs
+
+
+def avo_insar_submit_pairs( hyp3, asf_name, pairs, chunk_size=200, attempts=1 ):
+# submit InSAR jobs for {pairs} to project {asf_name}, in bulk requests of up to {chunk_size} jobs
+# a failed request is retried after checking which of its pairs made it into the project anyway, so a
+# request that failed after HyP3 accepted it is not submitted twice. Stops at the first chunk that
+# fails {attempts} times. Returns the sets of accepted pairs, and of pairs not submitted.
+# no deadline is put on the requests: a request given up on would carry on in the background, and could
+# land after the check of what the project holds. They are left to the HTTP client's own timeouts.
+    accepted = set()
+    pairs = sorted(pairs)
+    for start in range(0, len(pairs), chunk_size):
+        chunk = set(pairs[start:start+chunk_size])
+        tries = 0
+
+        def submit():
+            nonlocal tries
+            tries += 1
+            todo = chunk
+            if tries > 1:
+                present = avo_insar_job_pairs(hyp3.find_jobs(name=asf_name)) & chunk
+                accepted.update(present)
+                todo = chunk - present
+            if not todo:
+                return set()
+            prepared = [
+                hyp3.prepare_insar_job(reference, secondary, name=asf_name,
+                                       include_dem=True, include_look_vectors=True,
+                                       include_inc_map=True, include_displacement_maps=True,
+                                       apply_water_mask=True)
+                for reference, secondary in sorted(todo)
+            ]
+            return avo_insar_job_pairs(hyp3.submit_prepared_jobs(prepared))
+
+        try:
+            accepted.update(retry_call(submit, timeout=None, attempts=attempts))
+        except Exception as e:
+            print(f"Submission to {asf_name} failed ({e}).")
+            break
+    return accepted, set(pairs) - accepted
+
+
+def _up_to_date( asf_name , jobs , missing=None ): # check for jobs still to be downloaded
+# 0 for project {asf_name} being up to date, or 1 if {missing}(jobs) returns any succeeded {jobs} that
+# still have to be downloaded, e.g. jobs still running when an earlier run stopped waiting for them
+    undownloaded = missing(jobs) if missing is not None else []
+    if len(undownloaded):
+        print(f"    The project {asf_name} is up to date, but {len(undownloaded)} completed jobs are not downloaded.")
+        return( 1 )
+    print('    The project '+asf_name+' is up to date.')
+    return( 0 )
+
+
+def update_asf_project( path, frame, asf_name, hyp3, timeout=None, attempts=1, stack_cache=None, chunk_size=200,
+                        network='sbas', neighbours=3, job_budget=None, missing=None):
 # update the given project {asf_name}
-    jobs = hyp3.find_jobs(name=asf_name)
+# {network} 'sbas' pairs every two new scenes up to 48 days apart, plus a yearly pair. 'nearest' pairs each
+# new scene with its {neighbours} nearest earlier ones, plus annual bridges, submitting at most
+# {job_budget} new jobs beyond the two nearest pairs of each scene (see network.py)
+# each query to HyP3 and ASF gets {timeout} seconds, and is tried up to {attempts} times with jittered
+# backoff; empty search results count as failures, as they are mostly transient. New jobs are submitted
+# in bulk, {chunk_size} at a time, with the same number of attempts but no deadline.
+# the frame's baseline stack is kept in {stack_cache}, if given, so only new scenes have to be searched for
+# {missing}, if given, returns the succeeded jobs of a Batch not downloaded yet (e.g. DownloadCache.missing);
+# a project with nothing new to submit but any such jobs is reported as updated, so it gets processed
+    try:
+        jobs = retry_call(lambda: hyp3.find_jobs(name=asf_name), timeout=timeout, attempts=attempts)
+    except Exception as e:
+        print(f"Unable to find the jobs of {asf_name} ({e}). Check failed at project {asf_name}.")
+        return -1
     if not jobs:
         print(f"No jobs found for {asf_name}")
         return -1
@@ -145,72 +362,60 @@ def update_asf_project( path, frame, asf_name, hyp3):
     last_date = max( asfn.get_job_dates(jobs) )
     last_date = parse_date(last_date).date()
 
-    #TODO: can we limit this by date? 30 second timeout means timeouts are frequent.
-    search_results = asf.search(
-        platform=asf.SENTINEL1,
-        frame=frame,
-        relativeOrbit=path,
-        processingLevel='SLC',
-        start = '1 month ago'
-    )
-
-    if len(search_results) < 1:
-        print('An ASF search problem has occurred. Check failed at project '+asf_name+'.')
-        return( -1 )
-
     try:
-        baseline_results = search_results[-1].stack()
+        stack = baseline_cache.cached_stack(stack_cache, path, frame, timeout=timeout, attempts=attempts)
     except Exception as e:
         print(f"An ASF search problem has occurred ({e}) Check failed at project {asf_name}.")
         return -1
 
-    if len(baseline_results)==0:
-        print('An ASF search problem has occurred. Check failed at project '+asf_name+'.')
-        return( -1 )
-
-    columns = list(baseline_results[0].properties.keys()) + ['geometry', ] # these lines extract search result
-    data = [list(scene.properties.values()) + [scene.geometry, ] for scene in baseline_results]
-    stack = pd.DataFrame(data, columns=columns)
-    stack['startTime'] = stack.startTime.apply(parse_date)
-
     new_date = stack.startTime.iloc[-1].date()
     delta_date = new_date-last_date
 
     if delta_date.days>4:
-        sbas_pairs = set()
-        newstack = stack.loc[( pd.Timestamp(last_date+timedelta(days=-2),tz='UTC') <= stack.startTime) & (stack.startTime <= pd.Timestamp(new_date+timedelta(days=2),tz='UTC') )]
-        for reference, rt in newstack.loc[::-1, ['sceneName', 'temporalBaseline']].itertuples(index=False):
-            secondaries = newstack.loc[
-                (newstack.sceneName != reference)
-                & (newstack.temporalBaseline - rt <= 48) # 48 for max temporal baseline
-                & (newstack.temporalBaseline - rt > 0)
-            ]
-            for secondary in secondaries.sceneName:
-                sbas_pairs.add((reference, secondary))
-
-        last_year_time  = pd.Timestamp(new_date + timedelta(days=-365), tz='UTC')
-        last_year_scene = stack.iloc[(stack['startTime'] - last_year_time).abs().idxmin()]
-        new_time = pd.Timestamp(new_date, tz='UTC')
-        new_scene = stack.iloc[(stack['startTime'] - new_time).abs().idxmin()]
-        sbas_pairs.add((last_year_scene['sceneName'], new_scene['sceneName']))
-
-        sbas_pairs_list = list()
-        for tuple_name in sbas_pairs:
-            sbas_pairs_list.append(list(tuple_name))
-
-        jobs = sdk.Batch()
-        for reference, secondary in sbas_pairs_list:
-            jobs += hyp3.submit_insar_job(reference, secondary, name=asf_name,
-                                          include_dem=True, include_look_vectors=True,
-                                          include_inc_map=True, include_displacement_maps=True,
-                                          apply_water_mask=True)
-        print(f"Updated ASF project submitted for {asf_name}. Your new subset contains {len(sbas_pairs)} more pairs:")
-        for line in sbas_pairs_list:
+        window_start = pd.Timestamp(last_date+timedelta(days=-2),tz='UTC')
+        existing = avo_insar_job_pairs(jobs)
+        if network == 'nearest':
+            # the stack is in time order, so the new scenes are those from window_start on
+            first_new = int((stack.startTime < window_start).sum())
+            sbas_pairs = network_design.nearest_pairs(stack, first_new, neighbours)
+            sbas_pairs = set(sbas_pairs[0] + sbas_pairs[1])
+            chosen = network_design.design_pairs(stack, first_new, neighbours, budget=job_budget, exclude=existing)
+            if len(sbas_pairs - existing) > len(chosen):
+                print(f"    {len(sbas_pairs - existing) - len(chosen)} pairs for {asf_name} are over the job budget")
+        else:
+            newstack = stack.loc[( window_start <= stack.startTime) & (stack.startTime <= pd.Timestamp(new_date+timedelta(days=2),tz='UTC') )]
+            sbas_pairs = avo_insar_sbas_pairs(newstack, max_days=48) # 48 for max temporal baseline
+
+            last_year_time  = pd.Timestamp(new_date + timedelta(days=-365), tz='UTC')
+            last_year_scene = stack.iloc[(stack['startTime'] - last_year_time).abs().idxmin()]
+            new_time = pd.Timestamp(new_date, tz='UTC')
+            new_scene = stack.iloc[(stack['startTime'] - new_time).abs().idxmin()]
+            sbas_pairs.add((last_year_scene['sceneName'], new_scene['sceneName']))
+            chosen = sbas_pairs - existing
+
+        # the windows around last_date overlap earlier updates; don't submit any pair twice
+        duplicates = sbas_pairs & existing
+        sbas_pairs = chosen
+        if duplicates:
+            print(f"    {len(duplicates)} pairs for {asf_name} are already in the project")
+        if not sbas_pairs:
+            return _up_to_date(asf_name, jobs, missing)
+
+        accepted, missing = avo_insar_submit_pairs(hyp3, asf_name, sbas_pairs, chunk_size=chunk_size,
+                                                   attempts=attempts)
+        if missing:
+            print(f"{len(missing)} pairs could not be submitted to {asf_name}:")
+            for line in sorted(missing):
+                print('        '+line[0][17:25]+'_'+line[1][17:25])
+        if not accepted:
+            print(f"Check failed at project {asf_name}.")
+            return -1
+        print(f"Updated ASF project submitted for {asf_name}. Your new subset contains {len(accepted)} more pairs:")
+        for line in sorted(accepted):
             print('        '+line[0][17:25]+'_'+line[1][17:25])
         return( 1 )
     else:
-        print('    The project '+asf_name+' is up to date.')
-        return( 0 )
+        return _up_to_date(asf_name, jobs, missing)
 
 
 def avo_insar_difg( hyp3, asf_name , analysis_directory , date_range ):
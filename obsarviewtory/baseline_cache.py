@@ -0,0 +1,184 @@
+"""baseline_cache.py
+
+Local cache of the ASF baseline stack of each frame.
+
+Checking a project for updates needs the scene names, acquisition
+times and temporal baselines of every SLC of its frame. Fetching the
+baseline stack from ASF returns every scene back to 2014, with all of
+its properties, on every run. Instead, the three columns needed are
+kept locally, one small file per path/frame, and only scenes newer
+than the last cached one are searched for.
+
+Temporal baselines are only ever compared with each other, so they are
+stored as acquisition times, and computed relative to the newest scene
+when the stack is loaded.
+
+Functions
+---------
+load_stack(cache_dir, path, frame)
+    Return the cached stack of a frame
+cached_stack(cache_dir, path, frame, timeout, attempts)
+    Return the stack of a frame, updated with any new scenes
+"""
+
+import os
+import tempfile
+
+from pathlib import Path
+
+import asf_search as asf
+import numpy as np
+import pandas as pd
+
+try:
+    # When run as a module
+    from .retry import retry_call
+except ImportError:
+    # When run as a script
+    from retry import retry_call
+
+# Overlap of the search for new scenes with the cached ones, so scenes
+# published late are not missed
+SEARCH_OVERLAP = pd.Timedelta(days=2)
+
+
+def _stack_file(cache_dir: Path, path: int, frame: int) -> Path:
+    return Path(cache_dir) / f"path{path}_frame{frame}.npz"
+
+
+def _frame(scene_names, start_times) -> pd.DataFrame:
+    """Build a stack DataFrame, ordered by acquisition time, from its
+    scene names and start times"""
+    stack = pd.DataFrame({
+        'sceneName': np.asarray(scene_names, dtype=str),
+        'startTime': pd.to_datetime(start_times, utc=True),
+    })
+    stack = stack.drop_duplicates('sceneName').sort_values('startTime', ignore_index=True)
+    # Whole days between calendar dates, as in ASF's baselines. Differences
+    # of the times themselves round a scene a few seconds earlier in the
+    # day down to a day too many.
+    days = stack.startTime.dt.normalize()
+    stack['temporalBaseline'] = (days - days.iloc[-1]).dt.days
+    return stack
+
+
+def load_stack(cache_dir: Path, path: int, frame: int) -> pd.DataFrame | None:
+    """Return the cached stack of a frame
+
+    Parameters
+    ----------
+    cache_dir : Path
+        The directory holding the cached stacks
+    path : int
+        The relative orbit of the frame
+    frame : int
+        The frame number
+
+    Returns
+    -------
+    DataFrame or None
+        sceneName, startTime and temporalBaseline columns, ordered by
+        acquisition time, or None if the frame has not been cached
+    """
+    try:
+        with np.load(_stack_file(cache_dir, path, frame)) as data:
+            scene_names = data['sceneName']
+            start_times = data['startTime'].astype('datetime64[ms]')
+    except (FileNotFoundError, OSError, KeyError, ValueError):
+        return None
+    if not len(scene_names):
+        return None
+    return _frame(scene_names, start_times)
+
+
+def _save_stack(cache_dir: Path, path: int, frame: int, stack: pd.DataFrame) -> None:
+    stack_file = _stack_file(cache_dir, path, frame)
+    stack_file.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=stack_file.parent, suffix='.tmp', delete=False) as f:
+        np.savez(
+            f,
+            sceneName=stack.sceneName.to_numpy(dtype=str),
+            startTime=stack.startTime.dt.tz_localize(None).to_numpy(dtype='datetime64[ms]'),
+        )
+    os.replace(f.name, stack_file)
+
+
+def cached_stack(
+        cache_dir: Path | None,
+        path: int,
+        frame: int,
+        timeout: float | None = None,
+        attempts: int = 1) -> pd.DataFrame:
+    """Return the stack of a frame, updated with any new scenes
+
+    The first time a frame is seen, its full baseline stack is fetched
+    from ASF. After that, only scenes acquired since the newest cached
+    one are searched for.
+
+    Parameters
+    ----------
+    cache_dir : Path or None
+        The directory holding the cached stacks. If None, the full stack
+        is fetched and not cached.
+    path : int
+        The relative orbit of the frame
+    frame : int
+        The frame number
+    timeout : float, optional
+        The deadline of each query to ASF, in seconds (default: None)
+    attempts : int, optional
+        The number of times each query is tried (default: 1)
+
+    Returns
+    -------
+    DataFrame
+        sceneName, startTime and temporalBaseline columns, ordered by
+        acquisition time
+
+    Raises
+    ------
+    IOError
+        If ASF returns no scenes for a frame not cached yet
+    """
+    stack = None if cache_dir is None else load_stack(cache_dir, path, frame)
+    start = '1 month ago' if stack is None else (stack.startTime.iloc[-1] - SEARCH_OVERLAP).isoformat()
+
+    def search():
+        results = asf.search(
+            platform=asf.SENTINEL1,
+            frame=frame,
+            relativeOrbit=path,
+            processingLevel='SLC',
+            start=start
+        )
+        # Without a cached stack there must be a scene to stack on, and an
+        # empty result is mostly transient, so it is retried.
+        if stack is None and len(results) < 1:
+            raise IOError('no search results')
+        return results
+
+    results = retry_call(search, timeout=timeout, attempts=attempts)
+
+    if stack is None:
+        def baseline_stack():
+            scenes = results[-1].stack()
+            if len(scenes) == 0:
+                raise IOError('empty baseline stack')
+            return scenes
+
+        results = retry_call(baseline_stack, timeout=timeout, attempts=attempts)
+
+    new_names = pd.Series([scene.properties['sceneName'] for scene in results], dtype=object)
+    new_times = pd.to_datetime(
+        pd.Series([scene.properties['startTime'] for scene in results], dtype=object), utc=True
+    )
+    if stack is not None:
+        if new_names.isin(stack.sceneName).all():
+            return stack
+        new_names = pd.concat([stack.sceneName, new_names], ignore_index=True)
+        new_times = pd.concat([stack.startTime, new_times], ignore_index=True)
+
+    stack = _frame(new_names, new_times)
+    if cache_dir is not None:
+        _save_stack(cache_dir, path, frame, stack)
+    return stack
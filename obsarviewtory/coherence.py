@@ -0,0 +1,203 @@
+"""coherence.py
+
+Coherence screening of cropped interferograms.
+
+Interferograms that are mostly decorrelated over a volcano (snow,
+vegetation, long temporal baselines) add unwrapping errors and noise
+to the time-series, and cost time to load and invert. Before MintPy
+loads a volcano's clips, the AOI coherence of every interferogram is
+summarized as its mean over the valid (nonzero) pixels and the fraction
+of those pixels at or above a coherence threshold. Interferograms below
+either limit are dropped from the analysis directory.
+
+The coherence clips of a volcano all cover the same AOI, so they are
+read into 3-D arrays of up to BATCH clips and summarized in one
+vectorized pass per batch. The statistics are kept per volcano, and
+only clips not seen before (or all of them, after a change of AOI or
+threshold) are read on later runs.
+
+Direct ingestion (see ifgram_stack.py) reads the coherence windows
+itself, and screens each of them with is_coherent as it goes.
+
+Functions
+---------
+coherence_stats(corr_files, threshold)
+    Return the AOI coherence statistics of coherence clips
+is_coherent(data, threshold, min_mean, min_fraction)
+    Return whether a coherence window passes the screening
+screen(analysis_directory, volcano, stats_file, threshold, min_mean, min_fraction)
+    Drop the interferograms of low coherence from an analysis directory
+"""
+
+import json
+import os
+import shutil
+
+from pathlib import Path
+
+import numpy as np
+
+from osgeo import gdal
+
+# The number of clips summarized at once
+BATCH = 64
+
+CORR_SUFFIX = '_corr_clip.tif'
+
+
+def _summarize(batch: np.ndarray, threshold: float) -> tuple:
+    """Mean coherence and coherent fraction of each layer of a 3-D
+    array, over its nonzero pixels"""
+    valid = batch > 0
+    count = valid.sum(axis=(1, 2))
+    total = np.where(valid, batch, 0).sum(axis=(1, 2), dtype=np.float64)
+    # Compared in the data's own precision, so a pixel stored at exactly
+    # the threshold counts as coherent
+    coherent = (valid & (batch >= np.asarray(threshold, dtype=batch.dtype))).sum(axis=(1, 2))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(count > 0, total / count, 0.)
+        fraction = np.where(count > 0, coherent / count, 0.)
+    return (mean, fraction)
+
+
+def coherence_stats(corr_files: list, threshold: float) -> dict:
+    """Return the AOI coherence statistics of coherence clips
+
+    Parameters
+    ----------
+    corr_files : list
+        Paths of *_corr_clip.tif files
+    threshold : float
+        The coherence a pixel needs to count as coherent
+
+    Returns
+    -------
+    dict
+        (mean, fraction) tuples, keyed by product name (the name of
+        each clip's directory). Clips that can't be read are left out.
+    """
+    # Group the clips by shape, so each group can be stacked. They all
+    # share the AOI, so there is normally only one.
+    stats = {}
+    groups = {}
+    for fname in corr_files:
+        ds = gdal.Open(str(fname))
+        if ds is None:
+            continue
+        data = ds.ReadAsArray()
+        ds = None
+
+        batch = groups.setdefault(data.shape, [])
+        batch.append((Path(fname).parent.name, data))
+        if len(batch) == BATCH:
+            stats.update(_batch_stats(batch, threshold))
+            batch.clear()
+
+    for batch in groups.values():
+        if batch:
+            stats.update(_batch_stats(batch, threshold))
+    return stats
+
+
+def is_coherent(data: np.ndarray, threshold: float = 0.3, min_mean: float = 0., min_fraction: float = 0.) -> bool:
+    """Return whether a coherence window passes the screening
+
+    Parameters
+    ----------
+    data : ndarray
+        The AOI coherence of an interferogram, 0 where there is no data
+    threshold : float, optional
+        The coherence a pixel needs to count as coherent (default: 0.3)
+    min_mean : float, optional
+        The minimum mean AOI coherence (default: 0)
+    min_fraction : float, optional
+        The minimum fraction of coherent AOI pixels (default: 0)
+
+    Returns
+    -------
+    bool
+        False if the window is below either limit
+    """
+    mean, fraction = _summarize(data[np.newaxis], threshold)
+    return bool(mean[0] >= min_mean and fraction[0] >= min_fraction)
+
+
+def _batch_stats(batch: list, threshold: float) -> dict:
+    """Statistics of a list of (product, array) of one shape"""
+    names = [name for name, _ in batch]
+    mean, fraction = _summarize(np.stack([data for _, data in batch]), threshold)
+    return {name: (float(m), float(f)) for name, m, f in zip(names, mean, fraction)}
+
+
+def _load_stats(stats_file: Path) -> dict | None:
+    try:
+        return json.loads(Path(stats_file).read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def screen(
+        analysis_directory: Path,
+        volcano,
+        stats_file: Path,
+        threshold: float = 0.3,
+        min_mean: float = 0.,
+        min_fraction: float = 0.) -> list:
+    """Drop the interferograms of low coherence from an analysis directory
+
+    Parameters
+    ----------
+    analysis_directory : Path
+        The directory holding the volcano's product directories of clips
+    volcano : VolcanoArea
+        The volcano the clips were cropped for
+    stats_file : Path
+        The file the volcano's coherence statistics are kept in
+    threshold : float, optional
+        The coherence a pixel needs to count as coherent (default: 0.3)
+    min_mean : float, optional
+        The minimum mean AOI coherence of an interferogram (default: 0)
+    min_fraction : float, optional
+        The minimum fraction of coherent AOI pixels of an interferogram
+        (default: 0)
+
+    Returns
+    -------
+    list
+        The names of the product directories removed
+    """
+    corr_files = sorted(Path(analysis_directory).glob(f"*/*{CORR_SUFFIX}"))
+
+    state = _load_stats(stats_file)
+    if state is None or (
+            state['ul'] != list(volcano.ul)
+            or state['lr'] != list(volcano.lr)
+            or state['threshold'] != threshold):
+        state = {'ul': list(volcano.ul), 'lr': list(volcano.lr), 'threshold': threshold, 'stats': {}}
+
+    stats = state['stats']
+    new_files = [f for f in corr_files if f.parent.name not in stats]
+    if new_files:
+        stats.update(coherence_stats(new_files, threshold))
+        stats_file = Path(stats_file)
+        stats_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = stats_file.with_suffix('.tmp')
+        tmp_file.write_text(json.dumps(state, indent=1))
+        os.replace(tmp_file, stats_file)
+
+    removed = []
+    for fname in corr_files:
+        product = fname.parent.name
+        if product not in stats:
+            continue
+        mean, fraction = stats[product]
+        if mean < min_mean or fraction < min_fraction:
+            shutil.rmtree(fname.parent, ignore_errors=True)
+            removed.append(product)
+
+    if removed:
+        print(f"{len(removed)} interferograms of low coherence removed for {volcano.volc_name}:")
+        for product in removed:
+            mean, fraction = stats[product]
+            print(f"    {product} (mean {mean:.2f}, {fraction:.0%} coherent)")
+    return removed
@@ -8,6 +8,8 @@ be overridden by providing a custom list to the InSARProcessor constructor.
 """
 
 from collections import defaultdict
+from pathlib import Path
+
 try:
     from .filter_dates import filter_dates
 except ImportError:
@@ -103,6 +105,146 @@ class ASFArea:
         self.last_date = new_date
 
 
+# ---------------- DOWNLOAD CACHE ------------------- #
+# Downloaded HyP3 products are kept in this directory between runs, so
+# each job only has to be downloaded once.
+download_cache_dir = Path(__file__).parent / 'downloads'
+
+# Maximum size of the download cache, in GB. When exceeded, the least
+# recently used products are removed. None for no limit.
+download_cache_max_gb = 500
+
+# Maximum number of files downloaded from HyP3 at once, shared between
+# all projects being downloaded.
+download_workers = 8
+
+# Number of source rasters cropped at once for each frame
+crop_workers = 8
+
+# Write MintPy's inputs/ifgramStack.h5 and geometryGeo.h5 directly from
+# windowed reads of the downloads, instead of writing a cropped GeoTIFF
+# per product for MintPy's load_data step to read back.
+direct_ingest = False
+
+# Keep each volcano's MintPy directory, including its loaded stack and
+# geometry, between runs in stack_dir. New interferograms are appended to
+# the stack, and MintPy only reruns the steps whose inputs changed.
+# Implies direct_ingest.
+incremental = False
+stack_dir = Path(__file__).parent / 'stacks'
+
+# In incremental mode, extend the previous time-series with only the new
+# dates instead of inverting the full network. A full inversion is still
+# run when the network topology changes, or when the last full inversion
+# is more than full_inversion_days old.
+incremental_inversion = True
+full_inversion_days = 30
+
+# ERA5 data for MintPy's tropospheric correction is kept here, shared by
+# all volcanoes and between runs. The files a project needs are
+# downloaded era5_workers at a time before its MintPy runs start.
+weather_dir = Path(__file__).parent / 'weather'
+era5_workers = 4
+
+# The cropped geometry layers (DEM, look vectors, water mask) of each
+# volcano, and the geometryGeo.h5 built from them, are kept here between
+# runs. They are only cropped again when the AOI or frame geometry changes.
+geometry_dir = Path(__file__).parent / 'geometry'
+
+# The products of the last successful run of each volcano are kept here,
+# along with a fingerprint of the inputs they were made from (job IDs,
+# AOI and MintPy template). Volcanoes whose fingerprint has not changed
+# reuse these products instead of running MintPy again.
+results_dir = Path(__file__).parent / 'results'
+
+# Cropped interferograms whose mean AOI coherence is below
+# coherence_min_mean, or with less than coherence_min_fraction of their
+# AOI pixels at or above coherence_threshold, are dropped before MintPy
+# loads them. The statistics of every clip are kept in coherence_dir, so
+# only new clips are read on later runs. With direct_ingest, each
+# coherence window is screened as it is read instead, and the pairs
+# dropped are kept in the stack's ingest state.
+coherence_dir = Path(__file__).parent / 'coherence'
+coherence_threshold = 0.3
+coherence_min_mean = 0.2
+coherence_min_fraction = 0.1
+
+# MintPy runs are scheduled largest first, and only as many as fit in
+# mintpy_memory_budget_gb of memory by their estimated use (None for 80%
+# of physical memory). Measured runtimes, in core-seconds, used to
+# refine the estimates, are kept in runtime_history.
+# mintpy_cores (None for all CPUs) are shared between the runs and the
+# workers within each run: every run gets one core while projects are
+# still being prepared. After that, the free cores, and those freed by
+# finished runs, are shared out in proportion to the estimated remaining
+# cost of each run, including the runs already going, which pick up
+# their extra cores from their next MintPy step.
+# Each run processes its data in blocks of at most mintpy_max_memory_gb
+# (MintPy's mintpy.compute.maxMemory), which also caps its estimated
+# memory use.
+mintpy_cores = None
+mintpy_memory_budget_gb = None
+mintpy_max_memory_gb = 4
+runtime_history = Path(__file__).parent / 'runtimes.json'
+
+# ASF projects are checked for updates asf_check_workers at a time. Each
+# query to ASF or HyP3 gets asf_call_timeout seconds, and is tried up to
+# asf_call_attempts times, with jittered exponential backoff in between.
+asf_check_workers = 8
+asf_call_timeout = 120
+asf_call_attempts = 4
+
+# The scene names, acquisition times and temporal baselines of each
+# frame's SLC stack are kept here, so the update check only has to
+# search ASF for scenes newer than the last cached one.
+baseline_cache_dir = Path(__file__).parent / 'baselines'
+
+# New HyP3 jobs are submitted in bulk, up to submit_chunk_size jobs per
+# request (HyP3 accepts at most 200). A request that fails is retried as
+# the other ASF queries are, leaving out any jobs it turns out to have
+# created.
+submit_chunk_size = 200
+
+# How new HyP3 pairs are chosen. 'sbas' pairs every two new acquisitions
+# up to 48 days apart, plus a yearly pair. 'nearest' pairs each new
+# acquisition with its network_neighbours nearest earlier ones, plus
+# annual bridges, and submits at most network_job_budget new jobs per
+# project and update (None for no limit); the two nearest pairs of each
+# acquisition are kept whatever the budget. See network.py.
+pair_network = 'sbas'
+network_neighbours = 3
+network_job_budget = None
+
+# Before MintPy is started, the interferograms of each volcano must span
+# at least network_min_dates dates, form one connected network, and
+# include every date at least network_min_redundancy times. Volcanoes
+# failing any of these are rejected with the reason. Every date is in at
+# least one interferogram by definition, so redundancy starts at 2: a
+# date in a single interferogram has no check on its unwrapping.
+network_min_dates = 3
+network_min_redundancy = 2
+
+# Projects with newly submitted HyP3 jobs are each processed as soon as
+# their own jobs complete. Jobs are polled every watch_poll_min seconds,
+# backing off up to watch_poll_max seconds while nothing completes. After
+# watch_timeout seconds, the jobs completed so far are processed.
+watch_poll_min = 60
+watch_poll_max = 900
+watch_timeout = 8 * 3600
+
+# Wall-clock limits of each MintPy run, in seconds (None for no limit).
+# A run over task_timeout in total, or over the limit of the stage it is
+# in, is killed and recorded as failed in that stage. Stages are
+# 'geometry', 'ingest' or 'crop', and MintPy's steps (e.g.
+# 'correct_troposphere'). stage_timeouts overrides stage_timeout for
+# specific stages.
+task_timeout = 12 * 3600
+stage_timeout = 4 * 3600
+stage_timeouts = {
+    # Waits on ERA5 downloads
+    'correct_troposphere': 2 * 3600,
+}
+
 # ---------------- VOLCANO DEFINITIONS ------------------- #
 # order: volc_name, filter_dates, ul, lr, path, frame, asf_name
 # Coordinates are in UTM projection.
@@ -0,0 +1,136 @@
+"""cropping.py
+
+Frame-level cropping of downloaded HyP3 products.
+
+Several volcanoes are often covered by the same ASF project (frame).
+Rather than cropping every source raster once per volcano, the frame is
+cropped in a single pass: each source raster is opened once, and the
+clips for all volcanoes in the frame are written from that one open
+dataset. Source rasters are processed on a thread pool, as GDAL
+releases the GIL while reading and writing.
+
+Functions
+---------
+crop_frame(proj_downloads, targets, suffixes, workers, footprints)
+    Crop every source raster of a frame to the AOIs of its volcanoes
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from osgeo import gdal
+
+try:
+    # When run as a module
+    from . import avo_insar_functions, staging
+    from .footprints import FootprintIndex
+except ImportError:
+    # When run as a script
+    import avo_insar_functions
+    import staging
+    from footprints import FootprintIndex
+
+
+def _crop_source(fname: Path, targets: list) -> list:
+    """Write the clips of one source raster for all targets
+
+    Returns the list of clips removed for being empty.
+    """
+    product = fname.parent.name
+    removed = []
+    src = gdal.Open(str(fname))
+    if src is None:
+        return []
+
+    for volcano, analysis_directory in targets:
+        window = avo_insar_functions.avo_insar_window(src, volcano.ul, volcano.lr)
+        if window is None:
+            # AOI lies outside of this raster
+            continue
+
+        clip = analysis_directory / product / f"{fname.stem}_clip.tif"
+        gdal.Translate(destName=str(clip), srcDS=window)
+        window = None  # close the vrt
+
+        if "dem" not in fname.name and avo_insar_functions.avo_insar_empty(clip):
+            clip.unlink()
+            removed.append(clip)
+
+    src = None
+    return removed
+
+
+def crop_frame(
+        proj_downloads: Path,
+        targets: list,
+        suffixes: tuple,
+        workers: int | None = None,
+        footprints: FootprintIndex | None = None) -> list:
+    """Crop every source raster of a frame to the AOIs of its volcanoes
+
+    Clips are written to <analysis_directory>/<product>/<name>_clip.tif
+    for each target, skipping any product in the volcano's filter_dates
+    and, if a footprint index is given, any raster that does not overlap
+    the volcano's AOI. The product's metadata file, which MintPy reads
+    next to each raster, is linked in alongside the clips. Clips without
+    any valid (nonzero) pixels are removed, except for the DEM.
+
+    Parameters
+    ----------
+    proj_downloads : Path
+        The directory holding the downloaded product directories of the
+        frame
+    targets : list
+        (VolcanoArea, analysis_directory) tuples for the volcanoes in
+        the frame
+    suffixes : tuple
+        File name endings of the source rasters to crop
+    workers : int, optional
+        Number of source rasters cropped at once (default: None, the
+        ThreadPoolExecutor default)
+    footprints : FootprintIndex, optional
+        Footprints of the rasters in proj_downloads, used to skip
+        rasters outside of an AOI without opening them (default: None)
+
+    Returns
+    -------
+    list
+        The clips removed for being empty
+    """
+    fnames = sorted(
+        f for f in proj_downloads.glob('*/*.tif') if f.name.endswith(suffixes)
+    )
+
+    # The targets each source raster needs to be cropped for
+    tasks = []
+    for fname in fnames:
+        product = fname.parent.name
+        file_targets = [
+            (volcano, directory) for volcano, directory in targets
+            if product not in volcano.filter_dates
+            and (footprints is None or footprints.intersects(fname, volcano.ul, volcano.lr))
+        ]
+        if file_targets:
+            tasks.append((fname, file_targets))
+
+    # Create the product directories up front, with the metadata linked
+    # in, so the crop workers only ever write clips.
+    product_dirs = {
+        (directory, fname.parent) for fname, file_targets in tasks for _, directory in file_targets
+    }
+    for directory, source_dir in product_dirs:
+        clip_dir = directory / source_dir.name
+        clip_dir.mkdir(parents=True, exist_ok=True)
+        metadata = source_dir / f"{source_dir.name}.txt"
+        if metadata.exists():
+            staging.link_file(metadata, clip_dir / metadata.name)
+
+    removed = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='crop') as executor:
+        for result in executor.map(lambda task: _crop_source(*task), tasks):
+            removed.extend(result)
+
+    names = ', '.join(volcano.volc_name for volcano, _ in targets)
+    print(f"Cropped {len(tasks)} of {len(fnames)} rasters for {names}, "
+          f"{len(removed)} empty GeoTiffs removed")
+    return removed
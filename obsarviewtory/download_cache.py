@@ -0,0 +1,274 @@
+"""download_cache.py
+
+Persistent store for the files downloaded from HyP3.
+
+Each HyP3 job is downloaded and extracted exactly once, into a product
+directory below the project (asf_name) directory of the store. An index
+file keyed by HyP3 job ID records which jobs are present, how much
+space they use, and when they were last used, so that subsequent runs
+only need to download jobs they have not seen before.
+
+The store is bounded in size. When it grows past its limit, the least
+recently used jobs are evicted, never evicting a job that has been used
+during the current run.
+
+Classes
+-------
+DownloadCache
+    Persistent, size-bounded store of downloaded HyP3 products
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+
+from pathlib import Path
+
+import hyp3_sdk as sdk
+
+
+class DownloadCache:
+    """Persistent, size-bounded store of downloaded HyP3 products
+
+    Attributes
+    ----------
+    root : Path
+        The top level directory of the store
+    max_bytes : int or None
+        The maximum size of the store, in bytes. None for unbounded.
+
+    Methods
+    -------
+    project_dir(asf_name)
+        Return the directory holding the products of an ASF project
+    product_name(job)
+        Return the name of the product directory for a HyP3 job
+    missing(jobs)
+        Return the downloadable jobs not yet present in the store
+    project_jobs(asf_name)
+        Return the job IDs of the products of an ASF project in the store
+    touch(jobs)
+        Mark jobs as used by the current run
+    add(job, asf_name)
+        Record a downloaded and extracted job in the store
+    size()
+        Return the total size of the store, in bytes
+    evict()
+        Remove least recently used jobs until the store fits its limit
+    save()
+        Write the index to disk
+    """
+
+    INDEX_NAME = 'index.json'
+
+    def __init__(self, root: Path, max_bytes: int | None = None):
+        """
+        Parameters
+        ----------
+        root : Path
+            The top level directory of the store. Created if needed.
+        max_bytes : int, optional
+            The maximum size of the store, in bytes. If not provided,
+            the store is never evicted (default: None)
+        """
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+        self._index_file = self.root / self.INDEX_NAME
+        self._index = self._load()
+
+        # Job IDs used during this run. These are never evicted.
+        self._in_use = set()
+
+        # Projects may be downloaded from several threads at once
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks can't be pickled, which is needed to hand the processor
+        # to worker processes. Workers only read from the store.
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        """Load the index from disk, dropping entries whose product
+        directory no longer exists."""
+        try:
+            index = json.loads(self._index_file.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+        return {
+            job_id: entry for job_id, entry in index.items()
+            if (self.root / entry['asf_name'] / entry['product']).is_dir()
+        }
+
+    def project_dir(self, asf_name: str) -> Path:
+        """Return the directory holding the products of an ASF project
+
+        Parameters
+        ----------
+        asf_name : str
+            The ASF project name
+
+        Returns
+        -------
+        Path
+            The project directory. Created if needed.
+        """
+        proj_dir = self.root / asf_name
+        proj_dir.mkdir(parents=True, exist_ok=True)
+        return proj_dir
+
+    @staticmethod
+    def product_name(job: sdk.Job) -> str:
+        """Return the name of the product directory for a HyP3 job
+
+        HyP3 zip files extract into a directory of the same name as the
+        zip file, minus the extension.
+        """
+        return Path(job.files[0]['filename']).stem
+
+    def missing(self, jobs: sdk.Batch) -> sdk.Batch:
+        """Return the downloadable jobs not yet present in the store
+
+        Parameters
+        ----------
+        jobs : Batch
+            The jobs of an ASF project
+
+        Returns
+        -------
+        Batch
+            The jobs that succeeded, have not expired, and are not yet
+            in the store.
+        """
+        new_jobs = sdk.Batch()
+        for job in jobs:
+            if job.job_id in self._index:
+                continue
+            if job.succeeded() and not job.expired():
+                new_jobs += job
+        return new_jobs
+
+    def project_jobs(self, asf_name: str) -> dict:
+        """Return the job IDs of the products of an ASF project in the
+        store
+
+        Parameters
+        ----------
+        asf_name : str
+            The ASF project name
+
+        Returns
+        -------
+        dict
+            Job IDs, keyed by product name
+        """
+        with self._lock:
+            return {
+                entry['product']: job_id for job_id, entry in self._index.items()
+                if entry['asf_name'] == asf_name
+            }
+
+    def touch(self, jobs: sdk.Batch) -> None:
+        """Mark jobs as used by the current run
+
+        Parameters
+        ----------
+        jobs : Batch
+            The jobs to mark. Jobs not in the store are ignored.
+        """
+        now = time.time()
+        with self._lock:
+            for job in jobs:
+                entry = self._index.get(job.job_id)
+                if entry is not None:
+                    entry['last_used'] = now
+                    self._in_use.add(job.job_id)
+
+    def add(self, job: sdk.Job, asf_name: str) -> Path:
+        """Record a downloaded and extracted job in the store
+
+        Parameters
+        ----------
+        job : Job
+            The HyP3 job that was downloaded
+        asf_name : str
+            The ASF project the job belongs to
+
+        Returns
+        -------
+        Path
+            The product directory of the job
+        """
+        product = self.product_name(job)
+        product_dir = self.root / asf_name / product
+        size = sum(f.stat().st_size for f in product_dir.rglob('*') if f.is_file())
+
+        with self._lock:
+            self._index[job.job_id] = {
+                'asf_name': asf_name,
+                'product': product,
+                'size': size,
+                'last_used': time.time(),
+            }
+            self._in_use.add(job.job_id)
+        return product_dir
+
+    def size(self) -> int:
+        """Return the total size of the store, in bytes"""
+        with self._lock:
+            return sum(entry['size'] for entry in self._index.values())
+
+    def evict(self) -> list:
+        """Remove least recently used jobs until the store fits its limit
+
+        Jobs used during the current run are never removed, so the store
+        may remain over its limit if the current run needs more space
+        than allowed.
+
+        Returns
+        -------
+        list
+            The job IDs that were removed
+        """
+        if self.max_bytes is None:
+            return []
+
+        total = self.size()
+        removed = []
+        candidates = sorted(
+            (job_id for job_id in self._index if job_id not in self._in_use),
+            key=lambda job_id: self._index[job_id]['last_used']
+        )
+        for job_id in candidates:
+            if total <= self.max_bytes:
+                break
+
+            entry = self._index.pop(job_id)
+            shutil.rmtree(self.root / entry['asf_name'] / entry['product'], ignore_errors=True)
+            total -= entry['size']
+            removed.append(job_id)
+
+        if removed:
+            print(f"Evicted {len(removed)} jobs from the download cache")
+        return removed
+
+    def save(self) -> None:
+        """Write the index to disk
+
+        The index is written to a temporary file first and then moved
+        into place, so an interrupted run can not corrupt it.
+        """
+        with self._lock:
+            tmp_file = self._index_file.with_suffix('.tmp')
+            tmp_file.write_text(json.dumps(self._index, indent=1))
+            os.replace(tmp_file, self._index_file)
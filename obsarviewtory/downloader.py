@@ -0,0 +1,258 @@
+"""downloader.py
+
+Concurrent, resumable download engine for HyP3 job files.
+
+All downloads share a single keep-alive HTTP session and a bounded pool
+of worker threads, so several projects can download at once without
+opening an unbounded number of connections. Files are downloaded to a
+``.part`` file first, which is resumed with an HTTP range request if the
+connection drops, either during this run or on the next one.
+
+Classes
+-------
+Downloader
+    Bounded, pooled download engine for HyP3 jobs
+"""
+
+import os
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import hyp3_sdk as sdk
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class Downloader:
+    """Bounded, pooled download engine for HyP3 jobs
+
+    May be used as a context manager, in which case the worker pool
+    and HTTP session are closed on exit.
+
+    Methods
+    -------
+    download_file(url, filepath, size)
+        Download a single file, resuming any partial download
+    download_job(job, directory)
+        Download all files of a HyP3 job
+    submit(job, directory, process)
+        Schedule a HyP3 job for download on the worker pool
+    download_jobs(jobs, directory, process)
+        Download HyP3 jobs concurrently, yielding them as they complete
+    close()
+        Shut down the worker pool and close the HTTP session
+    """
+
+    def __init__(
+            self,
+            workers: int = 8,
+            retries: int = 5,
+            timeout: float = 60,
+            chunk_size: int = 1024 * 1024):
+        """
+        Parameters
+        ----------
+        workers : int, optional
+            Maximum number of files downloaded at once (default: 8)
+        retries : int, optional
+            Number of times to resume a file after the connection drops
+            before giving up (default: 5)
+        timeout : float, optional
+            Connect and read timeout for each request, in seconds
+            (default: 60)
+        chunk_size : int, optional
+            Size of the chunks written to disk, in bytes (default: 1 MB)
+        """
+        self._retries = retries
+        self._timeout = timeout
+        self._chunk_size = chunk_size
+
+        # One session, with a connection pool large enough for every
+        # worker, so connections are kept alive and reused.
+        retry = Retry(
+            total=retries,
+            backoff_factor=1,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['GET'],
+        )
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retry)
+        self._session = requests.Session()
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='download')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def download_file(self, url: str, filepath: Path, size: int | None = None) -> Path:
+        """Download a single file, resuming any partial download
+
+        Parameters
+        ----------
+        url : str
+            The URL to download
+        filepath : Path
+            The final location of the downloaded file
+        size : int, optional
+            The expected size of the file, in bytes. If provided, a
+            short download is resumed rather than accepted.
+
+        Returns
+        -------
+        Path
+            The downloaded file
+        """
+        filepath = Path(filepath)
+        if filepath.exists() and (size is None or filepath.stat().st_size == size):
+            return filepath
+
+        part = filepath.with_name(filepath.name + '.part')
+        error = None
+        for attempt in range(self._retries + 1):
+            if attempt:
+                time.sleep(min(2 ** attempt, 60))
+
+            offset = part.stat().st_size if part.exists() else 0
+            if size is not None and offset > size:
+                # Longer than the file itself, so the partial download
+                # is corrupt: start over
+                part.unlink()
+                offset = 0
+            if size is not None and offset == size:
+                break
+
+            headers = {'Range': f'bytes={offset}-'} if offset else {}
+            try:
+                with self._session.get(url, headers=headers, stream=True,
+                                       timeout=self._timeout) as response:
+                    if response.status_code == 416:
+                        # Range not satisfiable: we already have it all,
+                        # unless the file is shorter than expected
+                        if size is None:
+                            break
+                        part.unlink()
+                        error = f"range request at {offset} of {size} bytes refused"
+                        continue
+                    response.raise_for_status()
+
+                    # Servers that ignore the range request send the
+                    # whole file, so start over in that case.
+                    mode = 'ab' if response.status_code == 206 else 'wb'
+                    with open(part, mode) as f:
+                        for chunk in response.iter_content(chunk_size=self._chunk_size):
+                            f.write(chunk)
+            except requests.RequestException as e:
+                error = e
+                print(f"Download of {filepath.name} interrupted ({e}), resuming")
+                continue
+
+            received = part.stat().st_size
+            if size is None or received == size:
+                break
+            if received > size:
+                part.unlink()
+                error = f"received {received} bytes, more than the expected {size}"
+            else:
+                error = f"received {received} of {size} bytes"
+        else:
+            raise IOError(f"Unable to download {url}: {error}")
+
+        os.replace(part, filepath)
+        return filepath
+
+    def download_job(self, job: sdk.Job, directory: Path) -> list:
+        """Download all files of a HyP3 job
+
+        Parameters
+        ----------
+        job : Job
+            The job to download
+        directory : Path
+            The directory to download the files to
+
+        Returns
+        -------
+        list
+            The paths of the downloaded files
+        """
+        if not job.succeeded():
+            raise sdk.exceptions.HyP3SDKError(f'Only succeeded jobs can be downloaded; job is {job.status_code}.')
+        if job.expired():
+            raise sdk.exceptions.HyP3SDKError(f'Expired jobs cannot be downloaded; job expired {job.expiration_time}.')
+
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        return [
+            self.download_file(file['url'], directory / file['filename'], file.get('size'))
+            for file in job.files
+        ]
+
+    def _download_and_process(self, job, directory, process):
+        paths = self.download_job(job, directory)
+        if process is None:
+            return paths
+        return process(job, paths)
+
+    def submit(self, job: sdk.Job, directory: Path, process=None) -> Future:
+        """Schedule a HyP3 job for download on the worker pool
+
+        Parameters
+        ----------
+        job : Job
+            The job to download
+        directory : Path
+            The directory to download the files to
+        process : callable, optional
+            Called as process(job, paths) on the worker thread once the
+            job's files are downloaded, so that e.g. extraction of one
+            job overlaps the download of the next (default: None)
+
+        Returns
+        -------
+        Future
+            Resolves to the list of downloaded files, or the return
+            value of process if given
+        """
+        return self._pool.submit(self._download_and_process, job, directory, process)
+
+    def download_jobs(self, jobs: sdk.Batch, directory: Path, process=None):
+        """Download HyP3 jobs concurrently, yielding them as they complete
+
+        Parameters
+        ----------
+        jobs : Batch
+            The jobs to download
+        directory : Path
+            The directory to download the files to
+        process : callable, optional
+            Called as process(job, paths) on the worker thread once each
+            job's files are downloaded (default: None)
+
+        Yields
+        ------
+        job : Job
+            The job that completed
+        result : list or Exception
+            The downloaded files (or the result of process), or the
+            exception raised while downloading or processing them
+        """
+        futures = {self.submit(job, directory, process): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = e
+            yield futures[future], result
+
+    def close(self) -> None:
+        """Shut down the worker pool and close the HTTP session"""
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        self._session.close()
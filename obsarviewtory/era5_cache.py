@@ -0,0 +1,155 @@
+"""era5_cache.py
+
+Shared, persistent store of the ERA5 weather data used by MintPy's
+tropospheric delay correction.
+
+Every MintPy config points its weatherDir at the same directory, which
+is kept between runs, so each date and area is only ever downloaded
+once. MintPy names the GRIB files by date, hour and a bounding box
+rounded out to multiples of 10 degrees, so volcanoes on the same path
+share files.
+
+Before the MintPy workers start, the files a project will need are
+downloaded concurrently, so that the workers find them in place rather
+than each downloading them one at a time.
+
+Functions
+---------
+prefetch(proj_downloads, volcanoes, weather_dir, workers)
+    Download the ERA5 files needed by the volcanoes of a project
+"""
+
+import math
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from mintpy import tropo_pyaps3
+from osgeo import gdal, osr
+
+try:
+    # When run as a module
+    from .footprints import aoi_bounds
+except ImportError:
+    # When run as a script
+    from footprints import aoi_bounds
+
+
+def _snwe(ul: list, lr: list, srs: osr.SpatialReference, min_buffer: int = 2, step: int = 10) -> tuple:
+    """The area MintPy downloads ERA5 data for, for an AOI
+
+    Follows MintPy's get_snwe: the lat/lon bounding box, buffered and
+    rounded out to multiples of step degrees.
+    """
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(srs, wgs84)
+
+    minx, miny, maxx, maxy = aoi_bounds(ul, lr)
+    corners = [transform.TransformPoint(x, y)[:2] for x in (minx, maxx) for y in (miny, maxy)]
+    lons = [c[0] for c in corners]
+    lats = [c[1] for c in corners]
+
+    S = math.floor(min(lats) - min_buffer)
+    N = math.ceil(max(lats) + min_buffer)
+    W = math.floor(min(lons) - min_buffer)
+    E = math.ceil(max(lons) + min_buffer)
+    return (
+        math.floor(S / step) * step, math.ceil(N / step) * step,
+        math.floor(W / step) * step, math.ceil(E / step) * step
+    )
+
+
+def _center_line_utc(product_dir: Path) -> float | None:
+    """The UTC time of a product, in seconds of the day, as MintPy's
+    prep_hyp3 reads it into CENTER_LINE_UTC from the metadata file"""
+    try:
+        with open(product_dir / f"{product_dir.name}.txt") as f:
+            for line in f:
+                key, value = (line.strip().replace(' ', '').split(':') + [''])[:2]
+                if key == 'UTCtime':
+                    return float(value)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def prefetch(
+        proj_downloads: Path,
+        volcanoes: list,
+        weather_dir: Path,
+        workers: int = 4) -> int:
+    """Download the ERA5 files needed by the volcanoes of a project
+
+    Files already in the store are not downloaded again. Failed
+    downloads are only reported; MintPy will try them again itself.
+
+    Parameters
+    ----------
+    proj_downloads : Path
+        The directory holding the downloaded product directories
+    volcanoes : list
+        The VolcanoArea objects of the project that will be processed
+    weather_dir : Path
+        The shared weather directory, as given to MintPy
+    workers : int, optional
+        Number of files downloaded at once (default: 4)
+
+    Returns
+    -------
+    int
+        The number of files downloaded
+    """
+    products = sorted(
+        d for d in proj_downloads.iterdir()
+        if (d / f"{d.name}_unw_phase.tif").exists()
+    )
+    if not products or not volcanoes:
+        return 0
+
+    ds = gdal.Open(str(products[0] / f"{products[0].name}_unw_phase.tif"))
+    srs = osr.SpatialReference(wkt=ds.GetProjection())
+    ds = None
+
+    # MintPy picks the weather model hour from CENTER_LINE_UTC, the UTC
+    # time in the product metadata; the start time in the product name
+    # can round to a different hour. All acquisitions of a path are at
+    # nearly the same time of day, so one product will do.
+    seconds = _center_line_utc(products[0])
+    if seconds is None:
+        print(f"No UTC time in the metadata of {products[0].name}, not prefetching ERA5 data")
+        return 0
+    hour = tropo_pyaps3.closest_weather_model_hour(seconds, grib_source='ERA5')
+
+    # Dates needed for each area
+    areas = {}
+    for volcano in volcanoes:
+        snwe = _snwe(volcano.ul, volcano.lr, srs)
+        dates = areas.setdefault(snwe, set())
+        for product in products:
+            if product.name not in volcano.filter_dates:
+                dates.update((product.name[5:13], product.name[21:29]))
+
+    grib_dir = weather_dir / 'ERA5'
+    grib_dir.mkdir(parents=True, exist_ok=True)
+    missing = []
+    for snwe, dates in areas.items():
+        grib_files = tropo_pyaps3.get_grib_filenames(sorted(dates), hour, 'ERA5', str(grib_dir), snwe)
+        missing += [(f, snwe) for f in grib_files if not Path(f).exists()]
+
+    if not missing:
+        return 0
+
+    def download(item):
+        grib_file, snwe = item
+        try:
+            tropo_pyaps3.dload_grib_files([grib_file], tropo_model='ERA5', snwe=snwe)
+        except Exception as e:
+            print(f"Unable to download {grib_file}: {e}")
+        return Path(grib_file).exists()
+
+    print(f"Downloading {len(missing)} ERA5 files to {grib_dir}")
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='era5') as executor:
+        return sum(executor.map(download, missing))
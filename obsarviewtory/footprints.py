@@ -0,0 +1,150 @@
+"""footprints.py
+
+Spatial index of the footprints of downloaded rasters.
+
+The bounding box of every downloaded product is read once from a
+GeoTIFF header and cached in a small JSON file next to the downloads.
+All rasters of a HyP3 product share one grid, so one footprint is
+stored per product.
+
+This lets cropping skip rasters that do not touch a volcano's area of
+interest, and lets processing skip volcanoes that no new interferogram
+covers, without opening any rasters.
+
+Bounding boxes are in the raster's own coordinates, which are the same
+UTM coordinates used for VolcanoArea.ul and VolcanoArea.lr.
+
+Classes
+-------
+FootprintIndex
+    Cached bounding boxes of the rasters of one project download
+"""
+
+import json
+import os
+import threading
+
+from pathlib import Path
+
+from osgeo import gdal
+
+
+def aoi_bounds(ul: list, lr: list) -> tuple:
+    """Convert upper-left and lower-right corners to a
+    (minx, miny, maxx, maxy) bounding box"""
+    return (
+        min(ul[0], lr[0]), min(ul[1], lr[1]),
+        max(ul[0], lr[0]), max(ul[1], lr[1])
+    )
+
+
+def bounds_intersect(a: tuple, b: tuple) -> bool:
+    """Check if two (minx, miny, maxx, maxy) bounding boxes overlap"""
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+class FootprintIndex:
+    """Cached bounding boxes of the rasters of one project download
+
+    Attributes
+    ----------
+    proj_downloads : Path
+        The directory holding the downloaded product directories
+
+    Methods
+    -------
+    bounds(fname)
+        Return the bounding box of a raster
+    intersects(fname, ul, lr)
+        Check if a raster overlaps an area of interest
+    save()
+        Write the index to disk
+    """
+
+    INDEX_NAME = 'footprints.json'
+
+    def __init__(self, proj_downloads: Path):
+        """
+        Parameters
+        ----------
+        proj_downloads : Path
+            The directory holding the downloaded product directories
+        """
+        self.proj_downloads = Path(proj_downloads)
+        self._index_file = self.proj_downloads / self.INDEX_NAME
+        try:
+            self._index = json.loads(self._index_file.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._index = {}
+
+        self._lock = threading.Lock()
+        self._changed = False
+
+    def bounds(self, fname: Path) -> tuple | None:
+        """Return the bounding box of a raster
+
+        Parameters
+        ----------
+        fname : Path
+            A raster in the project download
+
+        Returns
+        -------
+        tuple or None
+            (minx, miny, maxx, maxy), or None if the raster can not be
+            read
+        """
+        key = Path(fname).parent.name
+        with self._lock:
+            if key in self._index:
+                return tuple(self._index[key])
+
+        ds = gdal.Open(str(fname))
+        if ds is None:
+            return None
+
+        gt = ds.GetGeoTransform()
+        xs = (gt[0], gt[0] + gt[1] * ds.RasterXSize)
+        ys = (gt[3], gt[3] + gt[5] * ds.RasterYSize)
+        bounds = (min(xs), min(ys), max(xs), max(ys))
+        ds = None
+
+        with self._lock:
+            self._index[key] = bounds
+            self._changed = True
+        return bounds
+
+    def intersects(self, fname: Path, ul: list, lr: list) -> bool:
+        """Check if a raster overlaps an area of interest
+
+        Rasters whose footprint can not be read are assumed to overlap,
+        so they are never skipped silently.
+
+        Parameters
+        ----------
+        fname : Path
+            A raster in the project download
+        ul : list
+            The upper-left corner of the area of interest
+        lr : list
+            The lower-right corner of the area of interest
+        """
+        bounds = self.bounds(fname)
+        if bounds is None:
+            return True
+        return bounds_intersect(bounds, aoi_bounds(ul, lr))
+
+    def save(self) -> None:
+        """Write the index to disk, dropping products no longer present"""
+        with self._lock:
+            if not self._changed:
+                return
+
+            self._index = {
+                key: bounds for key, bounds in self._index.items()
+                if (self.proj_downloads / key).is_dir()
+            }
+            tmp_file = self._index_file.with_suffix('.tmp')
+            tmp_file.write_text(json.dumps(self._index))
+            os.replace(tmp_file, self._index_file)
+            self._changed = False
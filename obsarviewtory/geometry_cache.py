@@ -0,0 +1,166 @@
+"""geometry_cache.py
+
+Per-volcano cache of the cropped geometry layers.
+
+The DEM, look vector and water mask rasters of a HyP3 project are the
+same for every job of the frame, so there is no need to crop a copy of
+each of them from every product on every run. Instead, one set of
+cropped geometry layers is kept for each volcano between runs, for
+MintPy's load_data step to read, along with the geometryGeo.h5 that
+direct ingestion copies into the MintPy inputs.
+
+The cache is only rebuilt when the volcano's AOI changes, or when the
+frame geometry it was cut from changes: a different projection, pixel
+size or pixel grid alignment of the source DEM.
+
+Functions
+---------
+ensure_geometry(proj_downloads, volcano, cache_dir, footprints)
+    Make sure the geometry cache of a volcano is up to date
+"""
+
+import json
+import shutil
+
+from pathlib import Path
+
+from osgeo import gdal
+
+try:
+    # When run as a module
+    from . import avo_insar_functions, ifgram_stack, staging
+    from .footprints import FootprintIndex, aoi_bounds
+except ImportError:
+    # When run as a script
+    import avo_insar_functions
+    import ifgram_stack
+    import staging
+    from footprints import FootprintIndex, aoi_bounds
+
+# Records what the cache was built from
+STATE_NAME = 'geometry.json'
+
+# The geometry file MintPy reads, as kept in the cache
+GEOMETRY_FILE = 'geometryGeo.h5'
+
+# Version of the cache contents. Caches of an older version are rebuilt.
+CACHE_VERSION = 2
+
+
+def _grid(fname: Path) -> dict | None:
+    """The grid of a raster that determines the content of its clips:
+    projection, pixel size and the alignment of the pixel grid"""
+    ds = gdal.Open(str(fname))
+    if ds is None:
+        return None
+    gt = ds.GetGeoTransform()
+    grid = {
+        'srs': ds.GetProjection(),
+        'res': [gt[1], gt[5]],
+        'origin': [round(gt[0] % gt[1], 6), round(gt[3] % abs(gt[5]), 6)],
+    }
+    ds = None
+    return grid
+
+
+def _source_product(proj_downloads: Path, volcano, footprints: FootprintIndex) -> Path | None:
+    """The newest product with geometry layers that overlaps the AOI,
+    preferring one that covers the AOI completely"""
+    aoi = aoi_bounds(volcano.ul, volcano.lr)
+    partial = None
+    # Product names are S1XY_<date1>T..._<date2>T..., so sort on the
+    # dates rather than the S1AA/S1BB prefix
+    products = sorted(proj_downloads.iterdir(), key=lambda p: (p.name[5:13], p.name), reverse=True)
+    for product_dir in products:
+        dem = product_dir / f"{product_dir.name}_dem.tif"
+        if product_dir.name in volcano.filter_dates or not dem.exists():
+            continue
+        if not footprints.intersects(dem, volcano.ul, volcano.lr):
+            continue
+
+        bounds = footprints.bounds(dem)
+        if bounds is None or (
+                bounds[0] <= aoi[0] and bounds[1] <= aoi[1]
+                and bounds[2] >= aoi[2] and bounds[3] >= aoi[3]):
+            return product_dir
+        if partial is None:
+            partial = product_dir
+    return partial
+
+
+def ensure_geometry(
+        proj_downloads: Path,
+        volcano,
+        cache_dir: Path,
+        footprints: FootprintIndex | None = None) -> Path | None:
+    """Make sure the geometry cache of a volcano is up to date
+
+    The cache directory holds the cropped geometry layers, laid out as
+    in an analysis directory (<product>/<product><suffix>_clip.tif, with
+    the product's metadata file next to them), and geometryGeo.h5.
+
+    Parameters
+    ----------
+    proj_downloads : Path
+        The directory holding the downloaded product directories
+    volcano : VolcanoArea
+        The volcano to cache the geometry for
+    cache_dir : Path
+        The geometry cache directory of this volcano
+    footprints : FootprintIndex, optional
+        Footprints of the products in proj_downloads (default: None,
+        read from proj_downloads)
+
+    Returns
+    -------
+    Path or None
+        cache_dir, or None if no product holds geometry for the AOI
+    """
+    if footprints is None:
+        footprints = FootprintIndex(proj_downloads)
+
+    source = _source_product(proj_downloads, volcano, footprints)
+    if source is None:
+        return None
+
+    grid = _grid(source / f"{source.name}_dem.tif")
+    state = {'ul': list(volcano.ul), 'lr': list(volcano.lr), 'grid': grid, 'version': CACHE_VERSION}
+    try:
+        cached = json.loads((cache_dir / STATE_NAME).read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        cached = None
+
+    if cached is not None and (cache_dir / GEOMETRY_FILE).exists():
+        if all(cached.get(key) == state[key] for key in ('ul', 'lr', 'grid', 'version')):
+            return cache_dir
+        print(f"AOI or frame geometry of {volcano.volc_name} changed, rebuilding the geometry cache")
+
+    # Build the new cache next to the old one, and swap it into place
+    # once complete.
+    tmp_dir = cache_dir.with_name(f"{cache_dir.name}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    clip_dir = tmp_dir / source.name
+    clip_dir.mkdir(parents=True)
+
+    for suffix in avo_insar_functions.GEOMETRY_SUFFIXES:
+        fname = source / f"{source.name}{suffix}"
+        if not fname.exists():
+            continue
+        window = avo_insar_functions.avo_insar_window(fname, volcano.ul, volcano.lr)
+        if window is None:
+            continue
+        gdal.Translate(destName=str(clip_dir / f"{fname.stem}_clip.tif"), srcDS=window)
+        window = None  # close the vrt
+
+    metadata = source / f"{source.name}.txt"
+    if metadata.exists():
+        staging.link_file(metadata, clip_dir / metadata.name)
+
+    ifgram_stack.write_geometry(source, volcano, tmp_dir / GEOMETRY_FILE)
+    state['product'] = source.name
+    (tmp_dir / STATE_NAME).write_text(json.dumps(state))
+
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    tmp_dir.rename(cache_dir)
+    print(f"Cached geometry for {volcano.volc_name} from {source.name}")
+    return cache_dir
@@ -0,0 +1,348 @@
+"""ifgram_stack.py
+
+Direct ingestion of HyP3 products into MintPy's input files.
+
+Rather than writing a cropped GeoTIFF for every product and having
+MintPy's load_data step open them all again, the AOI window of each
+source raster is read through a windowed VRT and written straight into
+inputs/ifgramStack.h5 and inputs/geometryGeo.h5, one interferogram
+(chunk) at a time. MintPy is then started at the modify_network step.
+
+A stack may also be kept between runs, in which case only the
+interferograms it does not hold yet are appended to it.
+
+Functions
+---------
+write_inputs(proj_downloads, volcano, inputs_dir, footprints, append, geometry_file, screening)
+    Write ifgramStack.h5 and geometryGeo.h5 for a volcano from the
+    project downloads
+write_geometry(product_dir, volcano, geometry_file)
+    Write geometryGeo.h5 from the geometry layers of one product
+stack_products(inputs_dir)
+    Return the names of the products in a stack
+"""
+
+import json
+import shutil
+import uuid
+
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from mintpy.prep_hyp3 import add_hyp3_metadata
+from mintpy.utils import readfile, utils as ut
+from osgeo import gdal
+
+try:
+    # When run as a module
+    from . import avo_insar_functions, coherence
+    from .footprints import FootprintIndex
+except ImportError:
+    # When run as a script
+    import avo_insar_functions
+    import coherence
+    from footprints import FootprintIndex
+
+# Records what has been written to a stack, for appending to it later
+STATE_NAME = 'ingest.json'
+
+# geometryGeo.h5 dataset names, and the HyP3 products they are read from
+GEOMETRY_PRODUCTS = {
+    'height': '_dem.tif',
+    'incidenceAngle': '_lv_theta.tif',
+    'azimuthAngle': '_lv_phi.tif',
+    'waterMask': '_water_mask.tif',
+}
+
+
+def _read_window(fname: Path, ul: list, lr: list) -> np.ndarray | None:
+    """Read the AOI window of a raster, or None if there is none"""
+    if not fname.exists():
+        return None
+    window = avo_insar_functions.avo_insar_window(fname, ul, lr)
+    if window is None:
+        return None
+    return window.ReadAsArray()
+
+
+def _metadata(fname: Path, ul: list, lr: list, is_ifg: bool) -> dict:
+    """MintPy attributes for the AOI window of a HyP3 raster
+
+    The window is written to an in-memory VRT so MintPy can read its
+    geographic attributes the same way its load_data step would.
+    """
+    vrt_name = f"/vsimem/{uuid.uuid4().hex}.vrt"
+    gdal.Translate(vrt_name, str(fname), format='VRT', projWin=[ul[0], ul[1], lr[0], lr[1]])
+    try:
+        meta = readfile.read_gdal_vrt(vrt_name)
+    finally:
+        gdal.Unlink(vrt_name)
+
+    meta = add_hyp3_metadata(str(fname), meta, is_ifg=is_ifg)
+    meta['PROCESSOR'] = 'hyp3'
+    return meta
+
+
+def _baseline(product_dir: Path) -> float:
+    """The perpendicular baseline of a product, from its metadata file"""
+    metadata = product_dir / f"{product_dir.name}.txt"
+    if metadata.exists():
+        for line in metadata.read_text().splitlines():
+            key, _, value = line.partition(':')
+            if key.strip() == 'Baseline':
+                return float(value)
+    return 0.
+
+
+def write_geometry(product_dir: Path, volcano, geometry_file: Path) -> None:
+    """Write geometryGeo.h5 from the geometry layers of one product
+
+    Parameters
+    ----------
+    product_dir : Path
+        The downloaded product directory to read the geometry layers from
+    volcano : VolcanoArea
+        The volcano whose AOI to read
+    geometry_file : Path
+        The file to write
+    """
+    name = product_dir.name
+    with h5py.File(geometry_file, 'w') as f:
+        for ds_name, suffix in GEOMETRY_PRODUCTS.items():
+            data = _read_window(product_dir / f"{name}{suffix}", volcano.ul, volcano.lr)
+            if data is None:
+                continue
+
+            # HyP3 look vectors are the elevation angle (lv_theta) and the
+            # orientation angle from east (lv_phi) of the LOS, in radians,
+            # with 0 for no data. MintPy wants the incidence angle, and the
+            # azimuth angle from north within [-180, 180], in degrees. As
+            # in MintPy's own hyp3 loader (stackDict.geometryDict).
+            if ds_name in ('incidenceAngle', 'azimuthAngle'):
+                data = data.astype(np.float32)
+                data[data == 0] = np.nan
+            if ds_name == 'incidenceAngle':
+                data = 90. - (data * 180. / np.pi)
+            elif ds_name == 'azimuthAngle':
+                data = data * 180. / np.pi - 90.
+                data = ut.wrap(data, wrap_range=[-180, 180])
+
+            if ds_name == 'waterMask':
+                data = data.astype(np.bool_)
+            else:
+                data = data.astype(np.float32)
+            f.create_dataset(ds_name, data=data, chunks=True)
+
+        meta = _metadata(product_dir / f"{name}_dem.tif", volcano.ul, volcano.lr, is_ifg=False)
+        meta['FILE_TYPE'] = 'geometry'
+        f.attrs.update(meta)
+
+
+def _readable(stack_file: Path) -> bool:
+    """Whether a stack can be opened to append to it"""
+    try:
+        with h5py.File(stack_file, 'r') as f:
+            f['date'][:]
+            f['unwrapPhase'].shape
+    except (OSError, KeyError):
+        return False
+    return True
+
+
+def _load_state(state_file: Path) -> dict | None:
+    try:
+        return json.loads(state_file.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def stack_products(inputs_dir: Path) -> list:
+    """Return the names of the products in a stack
+
+    Parameters
+    ----------
+    inputs_dir : Path
+        The MintPy inputs directory written by write_inputs
+
+    Returns
+    -------
+    list
+        The HyP3 product names of the interferograms in ifgramStack.h5
+    """
+    state = _load_state(inputs_dir / STATE_NAME)
+    return state['products'] if state is not None else []
+
+
+def write_inputs(
+        proj_downloads: Path,
+        volcano,
+        inputs_dir: Path,
+        footprints: FootprintIndex | None = None,
+        append: bool = False,
+        geometry_file: Path | None = None,
+        screening: dict | None = None) -> tuple:
+    """Write ifgramStack.h5 and geometryGeo.h5 for a volcano from the
+    project downloads
+
+    Products in the volcano's filter_dates, products that do not overlap
+    the AOI, interferograms without any valid (nonzero) pixels and, if
+    screening is given, interferograms of low AOI coherence are left
+    out, as they would be when cropping to GeoTIFFs.
+
+    Parameters
+    ----------
+    proj_downloads : Path
+        The directory holding the downloaded product directories
+    volcano : VolcanoArea
+        The volcano to write the inputs for
+    inputs_dir : Path
+        The MintPy inputs directory to write the files to
+    footprints : FootprintIndex, optional
+        Footprints of the products, used to skip products outside of the
+        AOI without opening them (default: None)
+    append : bool, optional
+        Keep the stack already in inputs_dir, and only append the
+        interferograms it does not hold yet. The stack is rebuilt from
+        scratch if the AOI changed, or if it holds products that are no
+        longer available or are now filtered. The geometry file is only
+        rewritten when the stack is rebuilt (default: False)
+    geometry_file : Path, optional
+        A geometryGeo.h5 already written for this volcano, e.g. by the
+        geometry cache, to copy rather than write a new one. It is
+        copied whenever it differs from the one in inputs_dir
+        (default: None)
+    screening : dict, optional
+        The threshold, min_mean and min_fraction of the coherence
+        screening (see coherence.is_coherent). The stack is rebuilt
+        when they change (default: None, no screening)
+
+    Returns
+    -------
+    total : int
+        The number of interferograms in the stack. If zero, no files
+        are written.
+    added : int
+        The number of interferograms written by this call
+    """
+    ul, lr = volcano.ul, volcano.lr
+    filter_dates = set(volcano.filter_dates)
+
+    products = []
+    for product_dir in sorted(proj_downloads.iterdir()):
+        unw_file = product_dir / f"{product_dir.name}_unw_phase.tif"
+        if product_dir.name in filter_dates or not unw_file.exists():
+            continue
+        if footprints is not None and not footprints.intersects(unw_file, ul, lr):
+            continue
+        products.append(product_dir)
+
+    inputs_dir.mkdir(parents=True, exist_ok=True)
+    stack_file = inputs_dir / 'ifgramStack.h5'
+    state_file = inputs_dir / STATE_NAME
+
+    state = _load_state(state_file) if append and stack_file.exists() else None
+    if state is not None and not _readable(stack_file):
+        print(f"The stack of {volcano.volc_name} can't be read, rebuilding it")
+        state = None
+    if state is not None and (
+            state['ul'] != list(ul)
+            or state['lr'] != list(lr)
+            or state.get('screening') != screening
+            or not set(state['products']) <= {p.name for p in products}):
+        print(f"Inputs for {volcano.volc_name} changed, rebuilding the stack")
+        state = None
+
+    if state is None:
+        state = {'ul': list(ul), 'lr': list(lr), 'screening': screening, 'products': [], 'empty': []}
+        mode = 'w'
+    else:
+        mode = 'a'
+
+    seen = set(state['products']) | set(state['empty'])
+    new_products = [p for p in products if p.name not in seen]
+
+    dates = []
+    bperp = []
+    drop = []
+    first = None
+    with h5py.File(stack_file, mode) as f:
+        if mode == 'a':
+            length, width = f['unwrapPhase'].shape[1:]
+            dates = [tuple(d.decode() for d in row) for row in f['date'][:]]
+            bperp = list(f['bperp'][:])
+            drop = list(f['dropIfgram'][:])
+
+        added = 0
+        for product_dir in new_products:
+            name = product_dir.name
+            unw = _read_window(product_dir / f"{name}_unw_phase.tif", ul, lr)
+            if unw is None or not np.any(unw):
+                state['empty'].append(name)
+                continue
+            cor = _read_window(product_dir / f"{name}_corr.tif", ul, lr)
+            if cor is None or cor.shape != unw.shape:
+                continue
+            if screening is not None and not coherence.is_coherent(cor, **screening):
+                print(f"Skipping {name}: low coherence")
+                state['empty'].append(name)
+                continue
+
+            if mode == 'w' and first is None:
+                first = product_dir
+                length, width = unw.shape
+                for ds_name in ('unwrapPhase', 'coherence'):
+                    f.create_dataset(
+                        ds_name,
+                        shape=(0, length, width),
+                        maxshape=(None, length, width),
+                        chunks=(1, length, width),
+                        dtype=np.float32
+                    )
+            elif unw.shape != (length, width):
+                print(f"Skipping {name}: window size {unw.shape} does not match the stack")
+                continue
+
+            i = len(dates)
+            for ds_name, data in (('unwrapPhase', unw), ('coherence', cor)):
+                f[ds_name].resize(i + 1, axis=0)
+                f[ds_name][i] = data
+
+            # Product names are S1XY_<date1>T..._<date2>T...
+            dates.append((name[5:13], name[21:29]))
+            bperp.append(_baseline(product_dir))
+            drop.append(True)
+            state['products'].append(name)
+            added += 1
+
+        if dates and (added or mode == 'w'):
+            for ds_name in ('date', 'bperp', 'dropIfgram'):
+                if ds_name in f:
+                    del f[ds_name]
+            f.create_dataset('date', data=np.array(dates, dtype=np.bytes_))
+            f.create_dataset('bperp', data=np.array(bperp, dtype=np.float32))
+            f.create_dataset('dropIfgram', data=np.array(drop, dtype=np.bool_))
+
+        if first is not None:
+            meta = _metadata(first / f"{first.name}_unw_phase.tif", ul, lr, is_ifg=True)
+            meta['FILE_TYPE'] = 'ifgramStack'
+            meta['LENGTH'] = str(length)
+            meta['WIDTH'] = str(width)
+            f.attrs.update(meta)
+
+    if not dates:
+        stack_file.unlink()
+        state_file.unlink(missing_ok=True)
+        return (0, 0)
+
+    geometry_out = inputs_dir / 'geometryGeo.h5'
+    if geometry_file is not None:
+        if not geometry_out.exists() or geometry_out.stat().st_mtime != geometry_file.stat().st_mtime:
+            shutil.copy2(geometry_file, geometry_out)
+    elif first is not None:
+        write_geometry(first, volcano, geometry_out)
+
+    state_file.write_text(json.dumps(state))
+    print(f"Wrote {added} interferograms for {volcano.volc_name} to {stack_file} ({len(dates)} total)")
+    return (len(dates), added)
@@ -0,0 +1,427 @@
+"""incremental_inversion.py
+
+Incremental time-series inversion for stacks kept between runs.
+
+When only a few pairs have been appended to a volcano's ifgramStack.h5,
+inverting the full network again for every pixel is wasteful. Instead,
+the time-series from the previous run (timeseries.h5, the raw inversion
+that timeseries_ERA5_demErr.h5 is derived from) is kept fixed for the
+dates it already holds, and only the new acquisition dates that the new
+pairs connect to are solved for:
+
+    A_new x_new = d - A_old x_old
+
+where d are the new pairs, referenced to the reference point, and x_old
+the known time-series values. The system is solved the way MintPy's
+network inversion solves the full one: pixel by pixel, leaving out the
+pairs with no data (zero or NaN phase) at each pixel, weighted by the
+spatial coherence with MintPy's weight function, and leaving unsolved
+the pixels where a new date is in fewer than minRedundancy pairs.
+MintPy zeroes the whole time-series of such a pixel, and so does the
+incremental inversion. The temporal coherence and number of pairs used
+(temporalCoherence.h5 and numInvIfgram.h5), which the later masking
+steps read, are then computed again over the full network. The MintPy
+corrections after the inversion step are rerun on the extended
+time-series as usual.
+
+A full inversion is needed, and should be run by MintPy instead, when
+the network topology changed (pairs dropped, pairs added between
+already known dates, a changed reference point), when the new dates are
+not uniquely determined by the new pairs, when the template masks the
+inversion with a dataset, or when the last full inversion is older than
+the configured schedule.
+
+Functions
+---------
+record_full_inversion(mintpy_directory)
+    Record the network used by a full MintPy inversion
+invert_new_dates(mintpy_directory, max_age_days)
+    Extend timeseries.h5 with the dates added since the last inversion
+"""
+
+import json
+import os
+import time
+
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from mintpy.simulation import decorrelation as decor
+from mintpy.utils import readfile, utils as ut
+
+# Records the network of the last inversion
+STATE_NAME = 'inversion.json'
+
+# The inversion quality files MintPy writes next to timeseries.h5
+TCOH_NAME = 'temporalCoherence.h5'
+NUM_INV_NAME = 'numInvIfgram.h5'
+
+# Number of values read into memory at once
+BLOCK_SIZE = 2 ** 24
+
+# Cut-off ratio of small singular values, as in MintPy's inversion
+RCOND = 1e-5
+
+TEMPLATE_PREFIX = 'mintpy.networkInversion.'
+
+
+def _network(stack_file: Path) -> tuple:
+    """The used pairs, as (date1, date2) tuples in stack order, and the
+    reference point of a stack"""
+    with h5py.File(stack_file, 'r') as f:
+        dates = [tuple(d.decode() for d in row) for row in f['date'][:]]
+        keep = f['dropIfgram'][:]
+        ref_yx = [int(f.attrs.get('REF_Y', -1)), int(f.attrs.get('REF_X', -1))]
+    return [pair for pair, use in zip(dates, keep) if use], ref_yx
+
+
+def _row_block(width: int, depth: int) -> int:
+    """Number of rows of depth layers that fit in BLOCK_SIZE values"""
+    return max(1, BLOCK_SIZE // (width * max(depth, 1)))
+
+
+def _inversion_options(mintpy_directory: Path) -> dict | None:
+    """The network inversion options of the MintPy directory's template,
+    or None if they need a full inversion"""
+    template = {}
+    template_file = mintpy_directory / 'smallbaselineApp.cfg'
+    if template_file.exists():
+        template = ut.check_template_auto_value(readfile.read_template(str(template_file)))
+
+    if template.get(TEMPLATE_PREFIX + 'maskDataset'):
+        return None
+    return {
+        'weight_func': template.get(TEMPLATE_PREFIX + 'weightFunc') or 'var',
+        'min_redundancy': float(template.get(TEMPLATE_PREFIX + 'minRedundancy') or 1.),
+    }
+
+
+def _read_phase(dset, index: list, rows: slice, ref_phase: np.ndarray) -> np.ndarray:
+    """Pairs of an unwrapPhase dataset, referenced as MintPy does, with
+    no data (zero phase) as NaN, in (pair, pixel) shape"""
+    obs = np.stack([dset[i, rows, :] for i in index]).reshape(len(index), -1)
+    obs = np.where(obs != 0, obs - ref_phase[:, None], obs)
+    obs[obs == 0] = np.nan
+    return obs
+
+
+def _weight_sqrt(dset, index: list, rows: slice, weight_func: str, looks: int) -> np.ndarray | None:
+    """Square root of MintPy's weights of pairs, from their coherence, in
+    (pair, pixel) shape"""
+    if weight_func in ('no', 'sbas'):
+        return None
+    coh = np.stack([dset[i, rows, :] for i in index]).reshape(len(index), -1)
+    coh[np.isnan(coh)] = 0.
+    weight = decor.coherence2weight(coh, weight_func, L=looks, epsilon=5e-2, print_msg=False)
+    return np.sqrt(weight)
+
+
+def _looks(attrs) -> int:
+    """MintPy's number of independent looks of a stack"""
+    if 'NCORRLOOKS' in attrs:
+        looks = float(attrs['NCORRLOOKS'])
+    else:
+        looks = int(attrs['ALOOKS']) * int(attrs['RLOOKS']) / 1.94
+    return max(int(np.rint(looks)), 1)
+
+
+def _solve(A: np.ndarray, obs: np.ndarray, weight_sqrt: np.ndarray | None = None, min_redundancy: float = 1.) -> tuple:
+    """Least-squares solution of A x = obs for each pixel, as MintPy's
+    estimate_timeseries
+
+    Parameters
+    ----------
+    A : ndarray
+        (pair, date) design matrix
+    obs : ndarray
+        (pair, pixel) observations, NaN where there is no data
+    weight_sqrt : ndarray, optional
+        (pair, pixel) square roots of the weights (default: None,
+        unweighted)
+    min_redundancy : float, optional
+        The minimum number of observations of each date. Pixels with
+        fewer are not solved. (default: 1)
+
+    Returns
+    -------
+    x : ndarray
+        (date, pixel) solutions, zero where not solved
+    count : ndarray
+        The number of observations used for each pixel, zero where not
+        solved
+    """
+    x = np.zeros((A.shape[1], obs.shape[1]), dtype=np.float32)
+    count = np.zeros(obs.shape[1], dtype=np.int16)
+
+    # Pixels with no data in the same pairs share a design matrix
+    valid = ~np.isnan(obs)
+    patterns, group = np.unique(valid, axis=1, return_inverse=True)
+    group = group.ravel()
+    for k, pattern in enumerate(patterns.T):
+        A_k = A[pattern]
+        if np.min(np.sum(A_k != 0, axis=0)) < min_redundancy:
+            continue
+        pixels = np.flatnonzero(group == k)
+        y = obs[pattern][:, pixels]
+        if weight_sqrt is None:
+            x[:, pixels] = np.linalg.lstsq(A_k, y, rcond=RCOND)[0]
+        elif np.linalg.matrix_rank(A_k) == A_k.shape[1]:
+            # Normal equations of every pixel at once
+            w = weight_sqrt[pattern][:, pixels] ** 2
+            N = np.einsum('ik,ip,il->pkl', A_k, w, A_k)
+            b = np.einsum('ik,ip->pk', A_k, w * y)
+            x[:, pixels] = np.linalg.solve(N, b[..., None])[..., 0].T
+        else:
+            for p in pixels:
+                w = weight_sqrt[pattern, p][:, None]
+                x[:, p] = np.linalg.lstsq(A_k * w, obs[pattern, p] * w[:, 0], rcond=RCOND)[0]
+        count[pixels] = pattern.sum()
+    return (x, count)
+
+
+def record_full_inversion(mintpy_directory: Path) -> None:
+    """Record the network used by a full MintPy inversion
+
+    Parameters
+    ----------
+    mintpy_directory : Path
+        The MintPy directory the inversion was run in
+    """
+    pairs, ref_yx = _network(mintpy_directory / 'inputs' / 'ifgramStack.h5')
+    state = {
+        'pairs': ['_'.join(pair) for pair in pairs],
+        'ref_yx': ref_yx,
+        'last_full': time.time(),
+    }
+    (mintpy_directory / STATE_NAME).write_text(json.dumps(state))
+
+
+def invert_new_dates(mintpy_directory: Path, max_age_days: float) -> bool:
+    """Extend timeseries.h5 with the dates added since the last inversion
+
+    Parameters
+    ----------
+    mintpy_directory : Path
+        The MintPy directory holding inputs/ifgramStack.h5 and the
+        timeseries.h5, temporalCoherence.h5 and numInvIfgram.h5 of the
+        previous inversion
+    max_age_days : float
+        Require a full inversion if the last one is older than this
+
+    Returns
+    -------
+    bool
+        True if timeseries.h5 is now up to date. False if a full
+        inversion is needed instead.
+    """
+    stack_file = mintpy_directory / 'inputs' / 'ifgramStack.h5'
+    ts_file = mintpy_directory / 'timeseries.h5'
+    num_file = mintpy_directory / NUM_INV_NAME
+    state_file = mintpy_directory / STATE_NAME
+
+    try:
+        state = json.loads(state_file.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+
+    if not (ts_file.exists() and num_file.exists()):
+        return False
+
+    if time.time() - state['last_full'] > max_age_days * 86400:
+        print(f"Last full inversion in {mintpy_directory} is over {max_age_days} days old")
+        return False
+
+    pairs, ref_yx = _network(stack_file)
+    if min(ref_yx) < 0 or ref_yx != state['ref_yx']:
+        print("Reference point changed, full inversion required")
+        return False
+
+    old_pairs = set(state['pairs'])
+    used = ['_'.join(pair) for pair in pairs]
+    if not old_pairs <= set(used):
+        print("Pairs were dropped from the network, full inversion required")
+        return False
+
+    options = _inversion_options(mintpy_directory)
+    if options is None:
+        print("Inversion is masked by a dataset, full inversion required")
+        return False
+
+    with h5py.File(ts_file, 'r') as f:
+        ts_dates = [d.decode() for d in f['date'][:]]
+    known = set(ts_dates)
+
+    new_idx = [i for i, name in enumerate(used) if name not in old_pairs]
+    if not new_idx:
+        return True
+
+    new_pairs = [pairs[i] for i in new_idx]
+    if any(d1 in known and d2 in known for d1, d2 in new_pairs):
+        print("New pairs between known dates, full inversion required")
+        return False
+
+    new_dates = sorted({d for pair in new_pairs for d in pair} - known)
+    col = {d: j for j, d in enumerate(new_dates)}
+    old_col = {d: j for j, d in enumerate(ts_dates)}
+
+    # Design matrices of the new pairs, for the new and the known dates
+    A_new = np.zeros((len(new_pairs), len(new_dates)), dtype=np.float32)
+    A_old = np.zeros((len(new_pairs), len(ts_dates)), dtype=np.float32)
+    for i, (d1, d2) in enumerate(new_pairs):
+        for d, sign in ((d1, -1), (d2, 1)):
+            if d in col:
+                A_new[i, col[d]] = sign
+            else:
+                A_old[i, old_col[d]] = sign
+
+    if np.linalg.matrix_rank(A_new) < len(new_dates):
+        print("New dates are not connected by the new pairs, full inversion required")
+        return False
+
+    old_used = np.flatnonzero(A_old.any(axis=0))
+
+    # Pixels the last inversion solved; the others stay zero
+    with h5py.File(num_file, 'r') as f:
+        solved = f['mask'][:] > 0
+
+    # Indices of the new pairs in the (unfiltered) stack
+    with h5py.File(stack_file, 'r') as f:
+        all_pairs = ['_'.join(d.decode() for d in row) for row in f['date'][:]]
+        stack_idx = [all_pairs.index('_'.join(pair)) for pair in new_pairs]
+        length, width = f['unwrapPhase'].shape[1:]
+        pair_bperp = f['bperp'][:][stack_idx]
+        looks = _looks(f.attrs)
+
+        # MintPy's conversion of phase to range change, in meters
+        phase2range = -1 * float(f.attrs['WAVELENGTH']) / (4. * np.pi)
+        ref_phase = np.array([f['unwrapPhase'][i, ref_yx[0], ref_yx[1]] for i in stack_idx])
+
+        new_ts = np.zeros((len(new_dates), length, width), dtype=np.float32)
+        step = _row_block(width, 2 * len(new_pairs) + old_used.size)
+        with h5py.File(ts_file, 'r') as ts:
+            ts_bperp = ts['bperp'][:]
+            for r0 in range(0, length, step):
+                rows = slice(r0, min(r0 + step, length))
+                obs = _read_phase(f['unwrapPhase'], stack_idx, rows, ref_phase)
+                if old_used.size:
+                    x_old = np.stack([ts['timeseries'][j, rows, :] for j in old_used])
+                    obs -= A_old[:, old_used] @ (x_old.reshape(old_used.size, -1) / phase2range)
+                weight_sqrt = _weight_sqrt(f['coherence'], stack_idx, rows, options['weight_func'], looks)
+
+                # Only the pixels solved before can be solved now
+                pixels = np.flatnonzero(solved[rows].ravel())
+                x, count = _solve(
+                    A_new,
+                    obs[:, pixels],
+                    None if weight_sqrt is None else weight_sqrt[:, pixels],
+                    options['min_redundancy']
+                )
+                block = np.zeros((len(new_dates), obs.shape[1]), dtype=np.float32)
+                block[:, pixels] = x * phase2range
+                new_ts[:, rows, :] = block.reshape(len(new_dates), -1, width)
+                done = np.zeros(obs.shape[1], dtype=bool)
+                done[pixels[count > 0]] = True
+                solved[rows] &= done.reshape(-1, width)
+
+    # The reference pixel has no data after referencing, but is solved
+    # by definition
+    solved[ref_yx[0], ref_yx[1]] = True
+
+    # The perpendicular baseline of the new dates follows from the same
+    # system
+    new_bperp = np.linalg.pinv(A_new) @ (pair_bperp - A_old @ ts_bperp)
+
+    _write_timeseries(ts_file, new_dates, new_ts, new_bperp, solved)
+    _write_quality(mintpy_directory, stack_file, pairs, ref_yx, solved)
+
+    state['pairs'] = used
+    state_file.write_text(json.dumps(state))
+    print(f"Incremental inversion added {len(new_dates)} dates from {len(new_pairs)} new pairs")
+    return True
+
+
+def _write_timeseries(
+        ts_file: Path,
+        new_dates: list,
+        new_ts: np.ndarray,
+        new_bperp: np.ndarray,
+        solved: np.ndarray) -> None:
+    """Write timeseries.h5 again with new dates merged in, in date order,
+    copying the existing dates one at a time and zeroing the pixels not
+    solved"""
+    tmp_file = ts_file.with_name('timeseries_incremental.h5')
+    with h5py.File(ts_file, 'r') as src, h5py.File(tmp_file, 'w') as dst:
+        old_dates = [d.decode() for d in src['date'][:]]
+        _, length, width = src['timeseries'].shape
+
+        merged = sorted(
+            [(d, 'old', i) for i, d in enumerate(old_dates)]
+            + [(d, 'new', i) for i, d in enumerate(new_dates)]
+        )
+        data = dst.create_dataset(
+            'timeseries',
+            shape=(len(merged), length, width),
+            chunks=(1, length, width),
+            dtype=np.float32
+        )
+        bperp = np.zeros(len(merged), dtype=np.float32)
+        old_bperp = src['bperp'][:]
+        for k, (d, source, i) in enumerate(merged):
+            if source == 'old':
+                data[k] = np.where(solved, src['timeseries'][i], 0.)
+                bperp[k] = old_bperp[i]
+            else:
+                data[k] = new_ts[i]
+                bperp[k] = new_bperp[i]
+
+        dst.create_dataset('date', data=np.array([d for d, _, _ in merged], dtype=np.bytes_))
+        dst.create_dataset('bperp', data=bperp)
+
+        dst.attrs.update(src.attrs)
+        if 'END_DATE' in dst.attrs:
+            dst.attrs['END_DATE'] = merged[-1][0]
+
+    os.replace(tmp_file, ts_file)
+
+
+def _write_quality(mintpy_directory: Path, stack_file: Path, pairs: list, ref_yx: list, solved: np.ndarray) -> None:
+    """Write temporalCoherence.h5 and numInvIfgram.h5 again for the full
+    network and the extended timeseries.h5, as MintPy computes them"""
+    tcoh_file = mintpy_directory / TCOH_NAME
+    num_file = mintpy_directory / NUM_INV_NAME
+    ts_file = mintpy_directory / 'timeseries.h5'
+
+    with h5py.File(stack_file, 'r') as f, h5py.File(ts_file, 'r') as ts, \
+            h5py.File(tcoh_file, 'r+') as tcoh, h5py.File(num_file, 'r+') as num:
+        all_pairs = ['_'.join(d.decode() for d in row) for row in f['date'][:]]
+        stack_idx = [all_pairs.index('_'.join(pair)) for pair in pairs]
+        ts_col = {d.decode(): j for j, d in enumerate(ts['date'][:])}
+        length, width = f['unwrapPhase'].shape[1:]
+        phase2range = -1 * float(f.attrs['WAVELENGTH']) / (4. * np.pi)
+        ref_phase = np.array([f['unwrapPhase'][i, ref_yx[0], ref_yx[1]] for i in stack_idx])
+
+        step = _row_block(width, len(ts_col) + 2)
+        for r0 in range(0, length, step):
+            rows = slice(r0, min(r0 + step, length))
+            x = ts['timeseries'][:, rows, :].reshape(len(ts_col), -1) / phase2range
+            total = np.zeros(x.shape[1], dtype=np.complex64)
+            count = np.zeros(x.shape[1], dtype=np.int16)
+
+            # One pair at a time, to hold only the time-series block
+            for k, (d1, d2) in enumerate(pairs):
+                obs = _read_phase(f['unwrapPhase'], [stack_idx[k]], rows, ref_phase[k:k + 1])[0]
+                valid = ~np.isnan(obs)
+                residual = obs - (x[ts_col[d2]] - x[ts_col[d1]])
+                total[valid] += np.exp(1j * residual[valid])
+                count += valid
+
+            ok = solved[rows].ravel() & (count > 0)
+            coherence = np.where(ok, np.abs(total) / np.maximum(count, 1), 0.)
+            tcoh['temporalCoherence'][rows, :] = coherence.reshape(-1, width)
+            num['mask'][rows, :] = np.where(ok, count, 0).reshape(-1, width)
+
+        # MintPy's values for the reference pixel
+        tcoh['temporalCoherence'][ref_yx[0], ref_yx[1]] = 1
+        num['mask'][ref_yx[0], ref_yx[1]] = len(pairs)
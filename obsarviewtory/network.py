@@ -0,0 +1,208 @@
+"""network.py
+
+Design of small, well connected interferogram networks.
+
+The default pair rule of update_asf_project takes every pair of
+acquisitions up to 48 days apart, so the number of HyP3 jobs, downloads
+and inversion equations per new acquisition grows with the acquisition
+rate. The nearest-neighbour network instead pairs each new acquisition
+with its few nearest earlier ones, plus one pair about a year long (an
+annual bridge), which ties seasons with poor coherence to the rest of
+the stack.
+
+Pairs are ranked by importance, and a per-project job budget drops the
+least important ones. The two nearest pairs of each new acquisition are
+always kept: the nearest one keeps the network connected, and the
+second closes a triangle with the previous acquisition's nearest pair,
+which MintPy's phase-closure unwrapping error correction relies on.
+
+Before MintPy is started, the network a volcano is left with, after its
+filter_dates and empty clips are taken out, is checked for a minimum
+number of dates, for connectivity and for a minimum number of
+interferograms per date, so a network MintPy can't invert is rejected
+before any time is spent on it.
+
+Functions
+---------
+nearest_pairs(stack, first_new, neighbours, bridge_days)
+    Return the pairs of a nearest-neighbour network, by importance
+design_pairs(stack, first_new, neighbours, budget, exclude)
+    Return the pairs to submit for the new acquisitions of a stack
+product_pairs(product_names)
+    Return the date pairs of HyP3 products
+check_network(pairs, min_dates, min_redundancy)
+    Return why an interferogram network can't be inverted, if it can't
+"""
+
+import numpy as np
+
+# Pairs to the nearest MIN_NEIGHBOURS earlier acquisitions are kept
+# whatever the job budget
+MIN_NEIGHBOURS = 2
+
+# Length of the annual bridge pairs, and how far the nearest acquisition
+# may be from it, in days
+BRIDGE_DAYS = 365
+BRIDGE_TOLERANCE = 60
+
+
+def nearest_pairs(stack, first_new: int, neighbours: int = 3, bridge_days: int = BRIDGE_DAYS) -> tuple:
+    """Return the pairs of a nearest-neighbour network, by importance
+
+    Parameters
+    ----------
+    stack : DataFrame
+        sceneName and temporalBaseline of the frame's acquisitions,
+        ordered by acquisition time
+    first_new : int
+        The position in stack of the first acquisition to pair
+    neighbours : int, optional
+        The number of earlier acquisitions each new one is paired with
+        (default: 3)
+    bridge_days : int, optional
+        The length of the annual bridge pairs (default: 365)
+
+    Returns
+    -------
+    required : list
+        (reference, secondary) pairs kept whatever the budget
+    optional : list
+        The other pairs, most important first: the newest acquisition's
+        bridge, the further neighbours by rank, then the other bridges
+    """
+    names = stack.sceneName.to_numpy()
+    baselines = stack.temporalBaseline.to_numpy()
+    if len(names) < 2:
+        return ([], [])
+
+    new = np.arange(max(first_new, 1), len(names))
+    tiers = []
+    for rank in range(1, neighbours + 1):
+        ref = new - rank
+        ok = ref >= 0
+        tiers.append(list(zip(names[ref[ok]], names[new[ok]])))
+
+    # Acquisition nearest to a year before each new one, newest first
+    target = baselines[new] - bridge_days
+    idx = np.clip(np.searchsorted(baselines, target), 1, len(names) - 1)
+    nearest = np.where(target - baselines[idx - 1] <= baselines[idx] - target, idx - 1, idx)
+    ok = (np.abs(baselines[nearest] - target) <= BRIDGE_TOLERANCE) & (nearest < new)
+    bridges = list(zip(names[nearest[ok]], names[new[ok]]))[::-1]
+
+    kept = min(neighbours, MIN_NEIGHBOURS)
+    required = [pair for tier in tiers[:kept] for pair in tier]
+    optional = bridges[:1] + [pair for tier in tiers[kept:] for pair in tier] + bridges[1:]
+
+    # A pair can turn up twice in a sparse stack, e.g. as neighbour and bridge
+    required = list(dict.fromkeys(required))
+    seen = set(required)
+    optional = [pair for pair in dict.fromkeys(optional) if pair not in seen]
+    return (required, optional)
+
+
+def design_pairs(
+        stack,
+        first_new: int,
+        neighbours: int = 3,
+        budget: int | None = None,
+        exclude=()) -> set:
+    """Return the pairs to submit for the new acquisitions of a stack
+
+    Parameters
+    ----------
+    stack : DataFrame
+        sceneName and temporalBaseline of the frame's acquisitions,
+        ordered by acquisition time
+    first_new : int
+        The position in stack of the first new acquisition
+    neighbours : int, optional
+        The number of earlier acquisitions each new one is paired with
+        (default: 3)
+    budget : int, optional
+        The maximum number of pairs to return. Exceeded only by the
+        pairs kept whatever the budget (default: None, no limit).
+    exclude : collection, optional
+        Pairs already in the project. They are not returned, and do not
+        count against the budget.
+
+    Returns
+    -------
+    set
+        (reference, secondary) pairs of scene names
+    """
+    exclude = set(exclude)
+    required, optional = nearest_pairs(stack, first_new, neighbours)
+    pairs = [pair for pair in required if pair not in exclude]
+    optional = [pair for pair in optional if pair not in exclude]
+    room = len(optional) if budget is None else max(budget - len(pairs), 0)
+    return set(pairs + optional[:room])
+
+
+def product_pairs(product_names) -> list:
+    """Return the date pairs of HyP3 products
+
+    Parameters
+    ----------
+    product_names : iterable
+        HyP3 product names, S1XY_<date1>T..._<date2>T...
+
+    Returns
+    -------
+    list
+        (date1, date2) tuples of YYYYMMDD strings
+    """
+    return [(name[5:13], name[21:29]) for name in product_names]
+
+
+def check_network(pairs, min_dates: int = 3, min_redundancy: int = 2) -> str | None:
+    """Return why an interferogram network can't be inverted, if it can't
+
+    Parameters
+    ----------
+    pairs : collection
+        (date1, date2) pairs of the interferograms
+    min_dates : int, optional
+        The minimum number of dates (default: 3)
+    min_redundancy : int, optional
+        The minimum number of interferograms every date must be in
+        (default: 2)
+
+    Returns
+    -------
+    str or None
+        The reason the network was rejected, or None if it passed
+    """
+    pairs = set(pairs)
+    dates = sorted({date for pair in pairs for date in pair})
+    if len(dates) < min_dates:
+        return f"Only {len(dates)} dates in the network (minimum {min_dates})"
+
+    degree = dict.fromkeys(dates, 0)
+    parent = {date: date for date in dates}
+
+    def root(date):
+        while parent[date] != date:
+            parent[date] = parent[parent[date]]
+            date = parent[date]
+        return date
+
+    for date1, date2 in pairs:
+        degree[date1] += 1
+        degree[date2] += 1
+        parent[root(date1)] = root(date2)
+
+    components = {}
+    for date in dates:
+        components.setdefault(root(date), []).append(date)
+    if len(components) > 1:
+        # Report where the network is split, from the first date of each part
+        starts = sorted(part[0] for part in components.values())
+        return f"Network is split into {len(components)} parts, starting {', '.join(starts)}"
+
+    thin = [date for date in dates if degree[date] < min_redundancy]
+    if thin:
+        return (
+            f"{len(thin)} dates are in fewer than {min_redundancy} interferograms"
+            f" (first {thin[0]})"
+        )
+    return None
@@ -0,0 +1,174 @@
+"""result_store.py
+
+Memoization of MintPy runs by the content of their inputs.
+
+Each volcano's inputs are summarized in a fingerprint: the HyP3 job IDs
+of the products that pass its filter_dates, its AOI, the MintPy
+template and any other settings that select its inputs. After a
+successful run, its products are kept in the store along with the
+fingerprint of the inputs they were made from. A later run with the
+same fingerprint can then reuse those products instead of running
+MintPy again.
+
+Every volcano has its own directory in the store, so volcanoes can be
+stored from separate worker processes without any locking.
+
+Classes
+-------
+ResultStore
+    Persistent store of the last products of each volcano
+
+Functions
+---------
+fingerprint(job_ids, volcano, template, settings)
+    Return the fingerprint of the inputs of a MintPy run
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+from pathlib import Path
+
+try:
+    # When run as a module
+    from . import staging
+except ImportError:
+    # When run as a script
+    import staging
+
+
+def fingerprint(job_ids: dict, volcano, template: str, settings: dict | None = None) -> str:
+    """Return the fingerprint of the inputs of a MintPy run
+
+    Parameters
+    ----------
+    job_ids : dict
+        HyP3 job IDs of the downloaded products, keyed by product name
+    volcano : VolcanoArea
+        The volcano to be run. Products in its filter_dates are left
+        out.
+    template : str
+        The MintPy template the volcano is run with
+    settings : dict, optional
+        Any other settings the products depend on, e.g. the limits of
+        the coherence screening. Must be JSON serializable
+        (default: None)
+
+    Returns
+    -------
+    str
+        A hex digest that changes whenever any of the inputs change
+    """
+    filter_dates = set(volcano.filter_dates)
+    content = {
+        'jobs': sorted(
+            job_id for product, job_id in job_ids.items() if product not in filter_dates
+        ),
+        'ul': list(volcano.ul),
+        'lr': list(volcano.lr),
+        'template': template,
+        'settings': settings or {},
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+class ResultStore:
+    """Persistent store of the last products of each volcano
+
+    Attributes
+    ----------
+    root : Path
+        The top level directory of the store
+
+    Methods
+    -------
+    fingerprint(key)
+        Return the fingerprint of the stored products of a volcano
+    restore(key, names, dest_dir)
+        Link the stored products of a volcano into a directory
+    store(key, fp, files)
+        Keep the products of a successful run
+    """
+
+    FINGERPRINT_NAME = 'fingerprint.txt'
+
+    def __init__(self, root: Path):
+        """
+        Parameters
+        ----------
+        root : Path
+            The top level directory of the store. Created if needed.
+        """
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def fingerprint(self, key: str) -> str | None:
+        """Return the fingerprint of the stored products of a volcano
+
+        Parameters
+        ----------
+        key : str
+            The volcano's key, e.g. its processing directory name
+
+        Returns
+        -------
+        str or None
+            The fingerprint, or None if nothing is stored
+        """
+        try:
+            return (self.root / key / self.FINGERPRINT_NAME).read_text().strip()
+        except FileNotFoundError:
+            return None
+
+    def restore(self, key: str, names: list, dest_dir: Path) -> bool:
+        """Link the stored products of a volcano into a directory
+
+        Parameters
+        ----------
+        key : str
+            The volcano's key
+        names : list
+            The file names of the products
+        dest_dir : Path
+            The directory to link the products into
+
+        Returns
+        -------
+        bool
+            False, and nothing linked, if any of the products is missing
+        """
+        store_dir = self.root / key
+        if not all((store_dir / name).is_file() for name in names):
+            return False
+
+        for name in names:
+            staging.link_file(store_dir / name, dest_dir / name)
+        return True
+
+    def store(self, key: str, fp: str, files: list) -> None:
+        """Keep the products of a successful run
+
+        Any previously stored products of the volcano are replaced. The
+        fingerprint is written last, so an interrupted store is never
+        mistaken for a complete one.
+
+        Parameters
+        ----------
+        key : str
+            The volcano's key
+        fp : str
+            The fingerprint of the inputs the products were made from
+        files : list
+            The product files. They are linked into the store, not moved.
+        """
+        store_dir = self.root / key
+        shutil.rmtree(store_dir, ignore_errors=True)
+        store_dir.mkdir(parents=True)
+        for f in files:
+            staging.link_file(Path(f), store_dir / Path(f).name)
+
+        tmp_file = store_dir / f"{self.FINGERPRINT_NAME}.tmp"
+        tmp_file.write_text(fp)
+        os.replace(tmp_file, store_dir / self.FINGERPRINT_NAME)
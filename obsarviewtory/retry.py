@@ -0,0 +1,88 @@
+"""retry.py
+
+Deadlines and retries for calls to remote services.
+
+Searches at ASF and queries to HyP3 fail now and then for transient
+reasons, or hang well past any useful time. A call made through
+retry_call is given up on after a deadline, and retried after a
+randomized, exponentially growing delay ("full jitter"), so that many
+concurrent callers don't all retry at the same moment.
+
+Functions
+---------
+retry_call(fn, timeout, attempts, base_delay, max_delay)
+    Call fn, retrying failures and calls over the deadline
+"""
+
+import random
+import threading
+import time
+
+
+def _call_with_deadline(fn, timeout: float | None):
+    """Call fn, raising TimeoutError if it takes longer than timeout
+
+    The call can not be interrupted, so on a timeout it is left to
+    finish in the background and its result is discarded.
+    """
+    if timeout is None:
+        return fn()
+
+    outcome = {}
+
+    def target():
+        try:
+            outcome['result'] = fn()
+        except BaseException as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise TimeoutError(f"No response within {timeout} seconds")
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
+
+
+def retry_call(
+        fn,
+        timeout: float | None = None,
+        attempts: int = 4,
+        base_delay: float = 2.,
+        max_delay: float = 60.):
+    """Call fn, retrying failures and calls over the deadline
+
+    Parameters
+    ----------
+    fn : callable
+        The call to make, without arguments (use a lambda or
+        functools.partial to pass any)
+    timeout : float, optional
+        The deadline of each attempt, in seconds (default: None, no
+        deadline)
+    attempts : int, optional
+        The maximum number of attempts (default: 4)
+    base_delay : float, optional
+        The delay before the first retry is drawn from 0 to base_delay
+        seconds, doubling with every further retry (default: 2)
+    max_delay : float, optional
+        The upper limit of the delay between attempts (default: 60)
+
+    Returns
+    -------
+    The return value of fn
+
+    Raises
+    ------
+    Exception
+        The exception of the last attempt, if all attempts failed
+    """
+    for attempt in range(attempts):
+        try:
+            return _call_with_deadline(fn, timeout)
+        except Exception:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(random.uniform(0, min(max_delay, base_delay * 2**attempt)))
@@ -14,27 +14,42 @@ InSARProcessor
 import os
 import shutil
 import subprocess
-import tempfile
 import time
 
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 
-from osgeo import gdal
-from osgeo_utils.gdal_merge import gdal_merge
-
 try:
     # When run as a module
-    from . import config, avo_insar_functions
+    from . import config, avo_insar_functions, coherence, cropping, era5_cache, geometry_cache, ifgram_stack, incremental_inversion, network, result_store, scheduler, staging, workers
+    from .download_cache import DownloadCache
+    from .downloader import Downloader
+    from .footprints import FootprintIndex
+    from .result_store import ResultStore
 except ImportError:
     # When run as a script
     import avo_insar_functions
+    import coherence
     import config
+    import cropping
+    import era5_cache
+    import geometry_cache
+    import ifgram_stack
+    import incremental_inversion
+    import network
+    import result_store
+    import scheduler
+    import staging
+    import workers
+    from download_cache import DownloadCache
+    from downloader import Downloader
+    from footprints import FootprintIndex
+    from result_store import ResultStore
 
 
 import hyp3_sdk as sdk
 from pathlib import Path
-from mintpy.cli.smallbaselineApp import main as smallbaselineApp
+from mintpy.cli.smallbaselineApp import STEP_LIST, main as smallbaselineApp
 
 
 class InSARProcessor:
@@ -52,6 +67,10 @@ class InSARProcessor:
         After running, will contain a list of volcano/asf_name
         combinations for which processing failed for any reason, along
         with a string stating the reason for failure.
+    skipped : list
+        After running, will contain a list of volcano/asf_name
+        combinations that were not processed because no new
+        interferogram covers them.
 
     Methods
     -------
@@ -59,10 +78,16 @@ class InSARProcessor:
         Shortcut function to run all processing steps other than upload
     update_projects()
         Update ASF projects, and mark associated volcanoes for update
+    wait_for_project(asf_name)
+        Wait for the HyP3 jobs submitted for an ASF project to complete
     process_volcanoes()
         Run processing for any volcanoes marked for update
-    ensure_downloads(volcano,proj_downloads)
-        Download ASF files for asf_project, if not already downloaded
+    ensure_downloads(volcano, proj_downloads, downloader)
+        Download any ASF files for asf_project not already in the
+        download cache
+    prepare_project(volcanoes, proj_downloads, downloader)
+        Download the ASF project of a group of volcanoes, and crop it
+        for all of them that new interferograms cover in a single pass
     grab_ifg(path, frame, proj_downloads)
         copy interferograms for the selected path/frame to the products
         directory
@@ -99,10 +124,11 @@ class InSARProcessor:
             updated or not (default: False)
         """
 
-        # List of succesfull and failed volcanoes/paths.
+        # List of succesfull, failed and skipped volcanoes/paths.
         # Populated after calling run_mintpy
         self.successful = []
         self.failed = []
+        self.skipped = []
 
         if not debug:
             self._hyp3 = sdk.HyP3(
@@ -126,16 +152,35 @@ class InSARProcessor:
         # Directory to store the output InSAR products in
         self._product_dir = Path(os.path.dirname(__file__), 'products')
 
-        # Use a temporary directory to store the downloaded files, so we
-        # only have to download once per asf_name. The downloaded files
-        # will be copied into the processing directory when needed.
-        # This directory will be automatically removed when class is destroyed.
-        self._download_dir = tempfile.TemporaryDirectory()
-        self._downloads = Path(self._download_dir.name)
+        # Persistent store of the downloaded files, keyed by HyP3 job ID,
+        # so each job only has to be downloaded once, ever. The
+        # downloaded files will be copied into the processing directory
+        # when needed.
+        max_gb = config.download_cache_max_gb
+        self._cache = DownloadCache(
+            config.download_cache_dir,
+            max_bytes=None if max_gb is None else int(max_gb * 1024**3)
+        )
+
+        # The products of the last successful run of each volcano, with
+        # the fingerprint of the inputs they were made from, so volcanoes
+        # whose inputs have not changed don't have to be run again.
+        self._results = ResultStore(config.results_dir)
+
+        # ASF projects with jobs submitted during this run
+        self._submitted = set()
+
+        # ASF projects whose downloads have been brought up to date
+        # during this run.
+        self._downloaded = set()
 
         self._debug = debug
         self._force = force
 
+        # Incremental processing appends to the MintPy input files
+        # directly, so it needs direct ingestion.
+        self._direct_ingest = config.direct_ingest or config.incremental
+
     def run(self) -> (list, list):
         """Run all processing steps, excluding file transfer to server
 
@@ -159,22 +204,46 @@ class InSARProcessor:
         Should the ASF search function return an error, any volcanoes
         associated with that project will be added to the failed list,
         and no generation will be attempted for those volcanoes.
+
+        This does not wait for the submitted jobs to complete. Each
+        project waits for its own jobs when it is processed, see
+        wait_for_project.
         """
 
-        # The last ASF project submitted for update, if any.
-        watch_name = None
-
-        for asf_project in self._asf_projects:
-            # Note: if something dies after running this, but before
-            # processing, this returns an up-to-date flag on the next
-            # run, potentially resulting in files not getting updated
-            # for one or more volcanoes/paths/frames.
-            asf_flag = avo_insar_functions.update_asf_project(
-                asf_project.path,
-                asf_project.frame,
-                asf_project.asf_name,
-                self._hyp3
-            )  # this function checks updates AND submit requests to ASF
+        # Check all projects at once, on a bounded pool. Each query gets
+        # a deadline, and is retried with jittered backoff, so transient
+        # ASF failures don't mark volcanoes as failed.
+        # Note: if something dies after running this, but before
+        # processing, this returns an up-to-date flag on the next
+        # run, potentially resulting in files not getting updated
+        # for one or more volcanoes/paths/frames.
+        with ThreadPoolExecutor(max_workers=config.asf_check_workers, thread_name_prefix='asf') as pool:
+            flags = pool.map(
+                lambda asf_project: avo_insar_functions.update_asf_project(
+                    asf_project.path,
+                    asf_project.frame,
+                    asf_project.asf_name,
+                    self._hyp3,
+                    timeout=config.asf_call_timeout,
+                    attempts=config.asf_call_attempts,
+                    stack_cache=config.baseline_cache_dir,
+                    chunk_size=config.submit_chunk_size,
+                    network=config.pair_network,
+                    neighbours=config.network_neighbours,
+                    job_budget=config.network_job_budget,
+                    missing=self._cache.missing
+                ),  # this function checks updates AND submit requests to ASF
+                self._asf_projects
+            )
+            flags = list(flags)
+
+        for asf_project, asf_flag in zip(self._asf_projects, flags):
+            if asf_flag > 0:
+                # New jobs were submitted for this project, or jobs
+                # submitted before have completed since it was last
+                # downloaded. Any of its jobs still pending have to
+                # complete before it can be processed.
+                self._submitted.add(asf_project.asf_name)
 
             # If the force flag is set, mark all volcanoes for
             # generation, unless the ASF project check failed.
@@ -182,12 +251,6 @@ class InSARProcessor:
                 asf_flag = 1
 
             if asf_flag > 0:
-                # We requested an update of a project, so mark that we
-                # need to watch for it to finish. At the end of the loop,
-                # this variable will contain the last project submitted,
-                # which presumably will be the last to complete.
-                watch_name = asf_project.asf_name
-
                 # Volcano update flag defaults to zero, so set it if
                 # asf_flag is 1
                 for volc in config.volc_lookup[asf_project.asf_name]:
@@ -202,11 +265,48 @@ class InSARProcessor:
                         f"{volc.volc_name} - {volc.asf_name}: Unable to check/update ASF project"
                     )
 
-        if watch_name is not None:
-            # wait for the last project submitted to complete.
-            # May take several hours.
-            jobs = self._hyp3.find_jobs(name=watch_name)
-            jobs = self._hyp3.watch(jobs)
+    def wait_for_project(self, asf_name: str) -> None:
+        """Wait for the HyP3 jobs of an ASF project to complete, if any
+        were submitted during this run
+
+        The jobs are polled, starting every config.watch_poll_min
+        seconds. The interval grows by half each time no job completed
+        since the last poll, up to config.watch_poll_max seconds, and
+        drops back whenever jobs complete. After config.watch_timeout
+        seconds, the project is processed with the jobs completed so
+        far. The update check of a later run finds the rest, once they
+        complete, missing from the download cache, and has the project
+        processed again.
+
+        Parameters
+        ----------
+        asf_name : str
+            The ASF project to wait for
+        """
+        if asf_name not in self._submitted:
+            return
+
+        start = time.monotonic()
+        interval = config.watch_poll_min
+        jobs = self._hyp3.find_jobs(name=asf_name)
+        # Refreshing takes a request per job, so only the jobs still
+        # pending are polled, not the whole project.
+        pending = sdk.Batch([job for job in jobs if not job.complete()])
+        while len(pending):
+            if time.monotonic() - start > config.watch_timeout:
+                print(f"Gave up waiting for {len(pending)} jobs of {asf_name}, processing the rest")
+                return
+
+            time.sleep(interval)
+            pending = self._hyp3.refresh(pending)
+            still_pending = sdk.Batch([job for job in pending if not job.complete()])
+            if len(still_pending) < len(pending):
+                interval = config.watch_poll_min
+            else:
+                interval = min(interval * 1.5, config.watch_poll_max)
+            pending = still_pending
+
+        print(f"All {len(jobs)} jobs of {asf_name} complete")
 
     def process_volcanoes(self) -> (list, list):
         """ Call required processing functions on all volcanoes in a
@@ -239,59 +339,152 @@ class InSARProcessor:
         insar_dir = self._product_dir / 'kml'
         insar_dir.mkdir(exist_ok=True)
 
-        # MintPy processes list
-        processings = []
-
-        # Run volcanoes in parallel
-        with ProcessPoolExecutor() as executor:
-            for volcano in self._volcanoes:
-                if volcano.run_flag != 1:
-                    continue
+        # Group the volcanoes to be run by ASF project, so each project
+        # is downloaded once.
+        projects = {}
+        for volcano in self._volcanoes:
+            if volcano.run_flag == 1:
+                projects.setdefault(volcano.asf_name, []).append(volcano)
+
+        # MintPy runs are started largest first, as far as the memory
+        # budget allows, using cost estimates calibrated against the
+        # runtimes of previous runs. The cores are shared between the
+        # runs and the workers within each run.
+        cores = config.mintpy_cores or os.cpu_count()
+        budget_gb = config.mintpy_memory_budget_gb
+        if budget_gb is None:
+            memory_budget = int(0.8 * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'))
+        else:
+            memory_budget = int(budget_gb * 1024**3)
+        costs = scheduler.CostModel(
+            config.runtime_history,
+            max_memory=int(config.mintpy_max_memory_gb * 1024**3)
+        )
 
+        # Each project waits for its own HyP3 jobs, then downloads
+        # through one pool of download workers shared by all projects.
+        # Volcanoes run in parallel as soon as their project has been
+        # downloaded, while other projects are still at ASF. Each MintPy
+        # run gets a process of its own, which is killed if the run takes
+        # too long.
+        with workers.TaskExecutor(
+                    task_timeout=config.task_timeout,
+                    stage_timeout=config.stage_timeout,
+                    stage_timeouts=config.stage_timeouts
+                ) as executor, \
+                Downloader(workers=config.download_workers) as downloader, \
+                ThreadPoolExecutor(max_workers=max(len(projects), 1)) as project_pool:
+            downloads = {}
+            for asf_name, volcanoes in projects.items():
                 # The directory holding the downloaded files for this
                 # volcano's path/frame
-                proj_downloads: Path = self._downloads / volcano.asf_name
+                proj_downloads: Path = self._cache.project_dir(asf_name)
 
                 # Make sure all files have been downloaded for this
-                # path/frame combination
-                self.ensure_downloads(volcano, proj_downloads)
-
-                # The following commented lines are if *NOT* running in
-                # parallel, the rest of the function is for when
-                # parallel processing is desired
-                # Pick one or the other, not both :)
-                # ------- Single processing ---------------#
-                # success, result = self.run_mintpy(volcano, proj_downloads)
-                # if success:
-                #     self.successful.append(result)
-                # else:
-                #     self.failed.append(result)
-                # ---------End Single Processing-------------#
-
-            # ---------Parallel Processing --------------#
-                # Submit the mintpy run to be processed in a parallel
-                # fashion
-                future = executor.submit(self.run_mintpy, volcano, proj_downloads)
-                processings.append(future)
-
-            # Once MintPy runs for all volcanoes are submitted, loop
-            # through the results as they become available
-            for future in processings:
-                success, result = future.result()
-                if success:
-                    self.successful.append(result)
-                else:
-                    self.failed.append(result)
-            # ------------End Parallel Processing ----------#
+                # path/frame combination, and crop them for all of its
+                # volcanoes
+                future = project_pool.submit(
+                    self.prepare_project, volcanoes, proj_downloads, downloader
+                )
+                downloads[future] = (volcanoes, proj_downloads)
+
+            mintpy_runs = scheduler.Scheduler(executor, cores, memory_budget)
+            sizes = {}
+            while downloads or mintpy_runs:
+                done, _ = wait(set(downloads) | mintpy_runs.running(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in downloads:
+                        self._queue_project(future, *downloads.pop(future), mintpy_runs, costs, sizes)
+                        if not downloads:
+                            mintpy_runs.close()
+                        continue
+
+                    volcano, _, core_seconds = mintpy_runs.finish(future)
+                    try:
+                        success, result = future.result()
+                    except Exception as e:
+                        success, result = False, f"{volcano.volc_name} - {volcano.asf_name}: {e}"
+                        # The worker may have been killed part way, so
+                        # don't leave its files for the next run.
+                        shutil.rmtree(self._analysis_directory(volcano), ignore_errors=True)
+                        if config.incremental:
+                            self._reset_stack(volcano)
+
+                    if success:
+                        self.successful.append(result)
+                        costs.record(self._analysis_directory(volcano).name, *sizes[volcano], core_seconds)
+                    else:
+                        self.failed.append(result)
+
+                mintpy_runs.dispatch()
+
+        costs.save()
+
+        # Trim the download cache now that nothing is reading from it.
+        self._cache.evict()
+        self._cache.save()
 
         return (self.successful, self.failed)
 
-    def ensure_downloads(self, volcano: config.VolcanoArea, proj_downloads: Path) -> None:
-        """Check for existing downloads for the ASF project associated
-        with this volcano, and download if needed.
+    def _queue_project(
+            self,
+            download,
+            volcanoes: list,
+            proj_downloads: Path,
+            mintpy_runs: scheduler.Scheduler,
+            costs: scheduler.CostModel,
+            sizes: dict) -> None:
+        """Queue the MintPy runs of a project whose preparation finished
+
+        Parameters
+        ----------
+        download : Future
+            The finished prepare_project call of the project
+        volcanoes : list
+            The volcanoes of the project
+        proj_downloads : Path
+            The directory containing the downloaded ASF project files
+        mintpy_runs : Scheduler
+            The scheduler to queue the runs on
+        costs : CostModel
+            The cost model to estimate the runs with
+        sizes : dict
+            Receives the (pixels, n_ifgs) size of each queued volcano
+        """
+        try:
+            to_run, skipped, rejected = download.result()
+        except Exception as e:
+            for volcano in volcanoes:
+                self.failed.append(
+                    f"{volcano.volc_name} - {volcano.asf_name}: Download/crop failed: {e}"
+                )
+            return
+
+        self.skipped.extend(skipped)
+        self.failed.extend(rejected)
+
+        footprints = FootprintIndex(proj_downloads)
+        for volcano, fingerprint in to_run:
+            sizes[volcano] = scheduler.task_size(proj_downloads, volcano, footprints)
+            cost, memory = costs.estimate(self._analysis_directory(volcano).name, *sizes[volcano])
+            mintpy_runs.add(
+                volcano, cost, memory,
+                self.run_mintpy, volcano, proj_downloads,
+                cropped=not self._direct_ingest,
+                fingerprint=fingerprint
+            )
+
+    def ensure_downloads(
+            self,
+            volcano: config.VolcanoArea,
+            proj_downloads: Path,
+            downloader: Downloader | None = None) -> list:
+        """Make sure the download cache holds every job of the ASF
+        project associated with this volcano, downloading only the jobs
+        not seen before.
 
         Will also copy interferogram files from the download to the
-        products directory when downloading.
+        products directory.
 
         Parameters
         ----------
@@ -299,19 +492,254 @@ class InSARProcessor:
             The volcano to ensure we have downloaded files for
         proj_downloads:
             The path where the downloaded files should be stored.
+        downloader : Downloader, optional
+            The download engine to use. Allows several projects to share
+            one pool of download workers (default: None, creates one)
+
+        Returns
+        -------
+        list
+            The names of the products newly downloaded by this call
         """
-        if not proj_downloads.exists():
+        if volcano.asf_name in self._downloaded:
+            print(f"Files for {volcano.asf_name} already downloaded. Skipping download.")
+            return []
+
+        jobs = self._hyp3.find_jobs(name=volcano.asf_name)
+        self._cache.touch(jobs)
+        new_jobs = self._cache.missing(jobs)
+
+        print(f"{len(jobs) - len(new_jobs)} jobs for {volcano.asf_name} found in download cache")
+        new_products = []
+        if new_jobs:
             print(f"Downloading files for {volcano.asf_name}")
-            avo_insar_functions.avo_insar_download(
+            downloaded = avo_insar_functions.avo_insar_download(
                 self._hyp3,
                 volcano.asf_name,
-                proj_downloads
+                proj_downloads,
+                jobs=new_jobs,
+                downloader=downloader
             )
+            for job in downloaded:
+                new_products.append(self._cache.add(job, volcano.asf_name).name)
 
-            # Grab any interferograms from this download
-            self.grab_ifg(volcano.path, volcano.frame, proj_downloads)
-        else:
-            print(f"Files for {volcano.asf_name} already downloaded. Skipping download.")
+            # Record progress right away, so an interrupted run doesn't
+            # have to download these again.
+            self._cache.save()
+
+        # Grab any interferograms from this download
+        self.grab_ifg(volcano.path, volcano.frame, proj_downloads)
+        self._downloaded.add(volcano.asf_name)
+        return new_products
+
+    def prepare_project(
+            self,
+            volcanoes: list,
+            proj_downloads: Path,
+            downloader: Downloader | None = None) -> (list, list, list):
+        """Download the ASF project shared by a list of volcanoes, and
+        crop it into each volcano's analysis directory in a single pass.
+
+        Waits for the project's HyP3 jobs to complete first, so each
+        project is processed as soon as it is ready, while others are
+        still processing at ASF.
+
+        Unless the force flag is set, volcanoes that no newly downloaded
+        interferogram covers are skipped. Volcanoes whose inputs are
+        unchanged since their last successful run are skipped as well,
+        and their stored products are linked into the products
+        directory. Interferograms of low coherence are dropped from the
+        cropped volcanoes, and those whose interferogram network then
+        fails the pre-flight checks are rejected before they are
+        queued. The ERA5 data needed by the volcanoes to be run is
+        fetched into the shared weather directory.
+
+        Parameters
+        ----------
+        volcanoes : list
+            The VolcanoArea objects to prepare. Must all share the same
+            ASF project.
+        proj_downloads : Path
+            The path where the downloaded files should be stored.
+        downloader : Downloader, optional
+            The download engine to use (default: None, creates one)
+
+        Returns
+        -------
+        to_run : list
+            (VolcanoArea, fingerprint) tuples for the volcanoes that were
+            prepared, and should be run
+        skipped : list
+            The volcanoes that were skipped, with the reason
+        rejected : list
+            The volcanoes rejected by the network checks, with the reason
+        """
+        self.wait_for_project(volcanoes[0].asf_name)
+        new_products = self.ensure_downloads(volcanoes[0], proj_downloads, downloader)
+        footprints = FootprintIndex(proj_downloads)
+        skipped = []
+
+        if not self._force:
+            covered = [
+                volcano for volcano in volcanoes
+                if any(
+                    footprints.intersects(
+                        proj_downloads / product / f"{product}_unw_phase.tif",
+                        volcano.ul,
+                        volcano.lr
+                    )
+                    for product in new_products
+                    if product not in volcano.filter_dates
+                )
+            ]
+            skipped += [
+                f"{volcano.volc_name} - {volcano.asf_name}: No new interferograms cover the area"
+                for volcano in volcanoes if volcano not in covered
+            ]
+            volcanoes = covered
+
+        # Reuse the last products of volcanoes whose inputs did not
+        # change, rather than running MintPy again for nothing. Only the
+        # jobs whose products cover a volcano are its inputs, so a new
+        # job elsewhere on the frame doesn't rerun it.
+        job_ids = self._cache.project_jobs(volcanoes[0].asf_name) if volcanoes else {}
+        to_run = []
+        for volcano in volcanoes:
+            volcano_jobs = {
+                product: job_id for product, job_id in job_ids.items()
+                if footprints.intersects(
+                    proj_downloads / product / f"{product}_unw_phase.tif",
+                    volcano.ul,
+                    volcano.lr
+                )
+            }
+            fingerprint = self._fingerprint(volcano, volcano_jobs)
+            key = self._analysis_directory(volcano).name
+            if (self._results.fingerprint(key) == fingerprint
+                    and self._results.restore(key, self._output_names(volcano), self._product_dir / 'insar')):
+                skipped.append(
+                    f"{volcano.volc_name} - {volcano.asf_name}: Inputs unchanged, kept the existing products"
+                )
+                continue
+            to_run.append((volcano, fingerprint))
+        volcanoes = [volcano for volcano, _ in to_run]
+
+        targets = []
+        for volcano in volcanoes:
+            analysis_directory = self._analysis_directory(volcano)
+
+            # Remove any existing processing directories. Leaving them
+            # can cause issues with leftover files from previous runs.
+            shutil.rmtree(analysis_directory, ignore_errors=True)
+            analysis_directory.mkdir(parents=True)
+            targets.append((volcano, analysis_directory))
+
+        # With direct ingestion, each volcano's MintPy worker reads the
+        # windows it needs itself.
+        if targets and not self._direct_ingest:
+            cropping.crop_frame(
+                proj_downloads,
+                targets,
+                avo_insar_functions.STAGE_SUFFIXES,
+                workers=config.crop_workers,
+                footprints=footprints
+            )
+        footprints.save()
+
+        # Drop the interferograms of low coherence, then check the network
+        # each volcano is left with, so a volcano MintPy can't invert
+        # never takes up a worker.
+        rejected = []
+        if targets and not self._direct_ingest:
+            for volcano, analysis_directory in targets:
+                self._screen_coherence(volcano, analysis_directory)
+                products = [f.parent.name for f in analysis_directory.glob('*/*_unw_phase_clip.tif')]
+                reason = self._check_network(products)
+                if reason is not None:
+                    rejected.append(f"{volcano.volc_name} - {volcano.asf_name}: {reason}")
+                    shutil.rmtree(analysis_directory, ignore_errors=True)
+                    to_run = [(v, fp) for v, fp in to_run if v is not volcano]
+            volcanoes = [volcano for volcano, _ in to_run]
+
+        # Fetch the weather data all of these volcanoes need for the
+        # tropospheric correction into the shared store, so their
+        # MintPy runs don't each download it one date at a time.
+        # Failures are left to MintPy, which will try again itself.
+        if volcanoes:
+            try:
+                era5_cache.prefetch(
+                    proj_downloads,
+                    volcanoes,
+                    config.weather_dir,
+                    workers=config.era5_workers
+                )
+            except Exception as e:
+                print(f"Unable to prefetch ERA5 data for {volcanoes[0].asf_name}: {e}")
+        return (to_run, skipped, rejected)
+
+    def _analysis_directory(self, volcano: config.VolcanoArea) -> Path:
+        """The processing directory for the given volcano"""
+        project_name = volcano.volc_name + str(volcano.path)
+        return self._processing_dir / project_name
+
+    def _screening(self) -> dict:
+        """The coherence screening settings, as keyword arguments of
+        coherence.screen and ifgram_stack.write_inputs"""
+        return {
+            'threshold': config.coherence_threshold,
+            'min_mean': config.coherence_min_mean,
+            'min_fraction': config.coherence_min_fraction,
+        }
+
+    def _screen_coherence(self, volcano: config.VolcanoArea, analysis_directory: Path) -> list:
+        """Drop the interferograms of low coherence from a volcano's
+        cropped clips, keeping their statistics for later runs"""
+        return coherence.screen(
+            analysis_directory,
+            volcano,
+            config.coherence_dir / f"{analysis_directory.name}.json",
+            **self._screening()
+        )
+
+    def _check_network(self, products: list) -> str | None:
+        """Why the network of the given products can't be run, if it
+        can't. No products at all counts as no images found."""
+        if not products:
+            return "No images found"
+        reason = network.check_network(
+            network.product_pairs(products),
+            min_dates=config.network_min_dates,
+            min_redundancy=config.network_min_redundancy
+        )
+        return None if reason is None else f"Network check failed: {reason}"
+
+    def _reset_stack(self, volcano: config.VolcanoArea) -> None:
+        """Have the next run rebuild the MintPy stack kept for a volcano
+
+        A run killed part way may have left the kept ifgramStack.h5 or
+        timeseries.h5 half written. Without their state files, the next
+        run writes the stack from scratch and inverts the full network.
+        """
+        mintpy_directory = config.stack_dir / self._analysis_directory(volcano).name / 'MintPy'
+        (mintpy_directory / 'inputs' / ifgram_stack.STATE_NAME).unlink(missing_ok=True)
+        (mintpy_directory / incremental_inversion.STATE_NAME).unlink(missing_ok=True)
+
+    def _output_names(self, volcano: config.VolcanoArea) -> list:
+        """The file names of the timeseries and velocity products of a
+        volcano"""
+        canonical_name = volcano.volc_name.lower().replace(' ', '')
+        output_ident = f"{canonical_name}_main_path{volcano.path}.h5"
+        return [f"timeseries_{output_ident}", f"velocity_{output_ident}"]
+
+    def _fingerprint(self, volcano: config.VolcanoArea, job_ids: dict) -> str:
+        """The fingerprint of the inputs of a volcano's MintPy run"""
+        analysis_directory = self._analysis_directory(volcano)
+        template = avo_insar_functions.avo_insar_template(
+            analysis_directory,
+            weather_dir=config.weather_dir,
+            geometry_directory=config.geometry_dir / analysis_directory.name
+        )
+        return result_store.fingerprint(job_ids, volcano, template, settings=self._screening())
 
     def grab_ifg(self, path: int, frame: int, proj_downloads: Path) -> None:
         """Copy interferogram kml files to the products directory
@@ -341,7 +769,13 @@ class InSARProcessor:
 
             shutil.copy(f, date_dir)
 
-    def run_mintpy(self, volcano: config.VolcanoArea, proj_downloads: Path) -> (bool, str):
+    def run_mintpy(
+            self,
+            volcano: config.VolcanoArea,
+            proj_downloads: Path,
+            cropped: bool = False,
+            fingerprint: str | None = None,
+            cores=1) -> (bool, str):
         """Run MintPy processing on the specified volcano
 
         Creates the velocity.h5 and timeseries.h5 files for the volcano,
@@ -354,6 +788,23 @@ class InSARProcessor:
         proj_downloads : Path
             The directory containing the downloaded ASF project files
             for this volcano.
+        cropped : bool, optional
+            Set if the cropped files have already been written to the
+            analysis directory, e.g. by prepare_project. Otherwise the
+            files are staged and cropped for this volcano alone
+            (default: False). Not used when config.direct_ingest or
+            config.incremental is set, in which case the MintPy input
+            files are written directly from the downloads.
+        fingerprint : str, optional
+            The fingerprint of the volcano's inputs. If given, the
+            products of a successful run are kept in the result store
+            under it (default: None)
+        cores : int or Value, optional
+            The number of cores MintPy may use for its parallel steps, or
+            a shared integer holding it, as passed by the Scheduler. It is
+            read again before each MintPy step, so the run picks up the
+            cores other runs free up
+            (default: 1)
 
         Returns
         -------
@@ -368,9 +819,12 @@ class InSARProcessor:
         os.chdir(os.path.dirname(__file__))
 
         print('########CURRENT PROJECT########')
-        project_name = volcano.volc_name + str(volcano.path)
-        analysis_directory: Path = self._processing_dir / project_name
+        analysis_directory: Path = self._analysis_directory(volcano)
         mintpy_directory = analysis_directory / 'MintPy'
+        if config.incremental:
+            # Keep the MintPy directory between runs, so MintPy can skip
+            # the steps whose inputs have not changed.
+            mintpy_directory = config.stack_dir / analysis_directory.name / 'MintPy'
 
         print(f"analysis_directory: {analysis_directory}")
 
@@ -378,76 +832,168 @@ class InSARProcessor:
         success = True
         result_string = f"{volcano.volc_name} - {volcano.asf_name}"
 
-        # Remove any existing processing directories. Leaving them can cause issues with leftover
-        # files from previous runs.
-        shutil.rmtree(analysis_directory, ignore_errors=True)
-
-        # Copy the download files into the analysis_directory
-        # Much faster than downloading again if we already have them.
-        # Don't copy over any files that are filtered for this volcano.
-        filter_dates = volcano.filter_dates
-        for f in proj_downloads.glob('*'):
-            if str(f.name) not in filter_dates:
-                shutil.copytree(f, analysis_directory / f.name, dirs_exist_ok=True)
-
-        # .tif files to be merged into the full area image
-        merge_paths = list(analysis_directory.glob('*/*_amp.tif'))
-
-        if not merge_paths:
-            print(f"No images found for {volcano.volc_name}")
-            return  # No data for this volcano
-
-        full_scene = analysis_directory / "full_scene.tif"  # create a full scene for cropping
-
-        # gdal_merge expects a sys.argv argument list in which the first
-        # argument is always the name of the script.
-        # Arguments: -o <output_file> input_file1 ... input_fileN
-        merge_args = ['gdal_merge.py', '-o', str(full_scene)] + [str(x) for x in merge_paths]
-        gdal_merge(merge_args)
-
-        # Create the vrt image
-        image_file = f"{analysis_directory}/raster_stack.vrt"
-        vrt_options = gdal.BuildVRTOptions(separate=True)
-        gdal.BuildVRT(image_file, [str(full_scene), ], options=vrt_options)
-
-        # Crop the image to the volcano area
-        avo_insar_functions.avo_insar_crop(
-            image_file,
-            volcano.ul,
-            volcano.lr,
-            analysis_directory
+        # The MintPy step to start at. Everything by default.
+        start_step = None
+
+        # The geometry layers are cropped once per volcano, and kept
+        # between runs.
+        workers.report_stage('geometry')
+        footprints = FootprintIndex(proj_downloads)
+        geometry_directory = geometry_cache.ensure_geometry(
+            proj_downloads,
+            volcano,
+            config.geometry_dir / analysis_directory.name,
+            footprints
         )
+        if geometry_directory is None:
+            print(f"No geometry found for {volcano.volc_name}")
+            shutil.rmtree(str(analysis_directory), ignore_errors=True)
+            return (False, f"{result_string}: No geometry found")
+        geometry_file = geometry_directory / geometry_cache.GEOMETRY_FILE
+
+        if self._direct_ingest:
+            # Stream the AOI windows straight into MintPy's input files,
+            # skipping the clip files and MintPy's load_data step.
+            # In incremental mode, only new interferograms are appended
+            # to the stack kept from the previous run.
+            if not cropped:
+                shutil.rmtree(analysis_directory, ignore_errors=True)
+
+            workers.report_stage('ingest')
+            num_ifgs, _ = ifgram_stack.write_inputs(
+                proj_downloads,
+                volcano,
+                mintpy_directory / 'inputs',
+                footprints,
+                append=config.incremental,
+                geometry_file=geometry_file,
+                screening=self._screening()
+            )
+            if not num_ifgs:
+                print(f"No images found for {volcano.volc_name}")
+                shutil.rmtree(str(analysis_directory), ignore_errors=True)
+                return (False, f"{result_string}: No images found")  # No data for this volcano
+
+            start_step = 'modify_network'
+
+        elif not cropped:
+            # Remove any existing processing directories. Leaving them can cause issues with leftover
+            # files from previous runs.
+            shutil.rmtree(analysis_directory, ignore_errors=True)
+
+            workers.report_stage('crop')
+
+            # Link the needed download files into the analysis_directory.
+            # Much faster than copying, let alone downloading again.
+            # Don't stage any files that are filtered for this volcano.
+            staging.stage_project(
+                proj_downloads,
+                analysis_directory,
+                volcano.filter_dates,
+                avo_insar_functions.STAGE_SUFFIXES
+            )
 
-        # Create a config file for MintPy and return the path to said file
-        mintpy_config = avo_insar_functions.avo_insar_run(analysis_directory, mintpy_directory)
+            # Crop the images to the volcano area
+            avo_insar_functions.avo_insar_crop(
+                volcano.ul,
+                volcano.lr,
+                analysis_directory
+            )
+            self._screen_coherence(volcano, analysis_directory)
+
+        # Check the network left after filtering and empty clip removal
+        # before spending any time on MintPy.
+        if start_step is None:
+            products = [f.parent.name for f in analysis_directory.glob('*/*_unw_phase_clip.tif')]
+        else:
+            products = ifgram_stack.stack_products(mintpy_directory / 'inputs')
+        reason = self._check_network(products)
+        if reason is not None:
+            print(f"{reason} for {volcano.volc_name}")
+            shutil.rmtree(str(analysis_directory), ignore_errors=True)
+            return (False, f"{result_string}: {reason}")
+
+        # Create a config file for MintPy with the given number of
+        # workers and return the path to said file
+        def write_config(num_workers):
+            return avo_insar_functions.avo_insar_run(
+                analysis_directory,
+                mintpy_directory,
+                weather_dir=config.weather_dir,
+                geometry_directory=geometry_directory,
+                num_workers=num_workers,
+                max_memory=config.mintpy_max_memory_gb
+            )
 
         # Run MintPy, keeping track of success and failure
-        app_args = ['--dir', str(mintpy_directory), str(mintpy_config)]
         try:
-            smallbaselineApp(app_args)
+            self._smallbaselineApp(mintpy_directory, write_config, cores, start_step)
         except Exception as e:
             # If we get some sort of exception running mintpy, capture
             # the exception string along with the volcano and ASF
             # project names.
             success = False
-            result_string = f"{volcano.volc_name} - {volcano.asf_name}: {e}"
+            result_string = f"{volcano.volc_name} - {volcano.asf_name}: {workers.current_stage()}: {e}"
         else:
             # Yay, it worked!
-            # Move the products to the output directory
-            canonical_name = volcano.volc_name.lower().replace(' ', '')
-            output_ident = f"{canonical_name}_main_path{volcano.path}.h5"
-            for product in ('timeseries_ERA5_demErr', 'velocity'):
-                dest = product.split('_')[0]  # timeseries or velocity
-                shutil.move(
-                    str(mintpy_directory / f"{product}.h5"),
-                    str(self._product_dir / 'insar' / f"{dest}_{output_ident}")
-                )
+            # Move the products to the output directory. In incremental
+            # mode, copy them instead, so MintPy sees them as up to date
+            # on the next run.
+            transfer = shutil.copy2 if config.incremental else shutil.move
+            outputs = [self._product_dir / 'insar' / name for name in self._output_names(volcano)]
+            for product, output in zip(('timeseries_ERA5_demErr', 'velocity'), outputs):
+                transfer(str(mintpy_directory / f"{product}.h5"), str(output))
+
+            if fingerprint is not None:
+                self._results.store(analysis_directory.name, fingerprint, outputs)
 
         # remove the processing directory, since we are now done with it
         shutil.rmtree(str(analysis_directory), ignore_errors=True)
 
         return (success, result_string)
 
+    def _smallbaselineApp(self, mintpy_directory: Path, write_config, cores, start_step: str | None) -> None:
+        """Run smallbaselineApp, using the incremental inversion where possible
+
+        In incremental mode, MintPy is run up to the network inversion.
+        If only new dates were added, the time-series from the previous
+        run is extended with them instead of inverting the full network,
+        and MintPy carries on from the step after the inversion.
+        Otherwise MintPy runs the full inversion, which is recorded as
+        the base for the next incremental one.
+
+        MintPy is run one step at a time, reporting each step as a stage
+        of the task, so each step can be held to its own time limit.
+        Before each step, the cores the run may use are read again, and
+        the config file, written by write_config(num_workers), is
+        rewritten if they changed.
+        """
+        num_workers = mintpy_config = None
+
+        def run_steps(start, end=None):
+            nonlocal num_workers, mintpy_config
+            first = STEP_LIST.index(start) if start is not None else 0
+            last = STEP_LIST.index(end) + 1 if end is not None else len(STEP_LIST)
+            for step in STEP_LIST[first:last]:
+                workers.report_stage(step)
+                available = cores if isinstance(cores, int) else cores.value
+                if available != num_workers:
+                    num_workers = available
+                    mintpy_config = write_config(num_workers)
+                smallbaselineApp(['--dir', str(mintpy_directory), str(mintpy_config), '--dostep', step])
+
+        if not (config.incremental and config.incremental_inversion):
+            run_steps(start_step)
+            return
+
+        run_steps(start_step, 'correct_unwrap_error')
+        workers.report_stage('incremental_inversion')
+        if incremental_inversion.invert_new_dates(mintpy_directory, config.full_inversion_days):
+            run_steps('correct_LOD')
+        else:
+            run_steps('invert_network')
+            incremental_inversion.record_full_inversion(mintpy_directory)
+
     def upload_files(self):
         """Upload the product files to the server
 
@@ -515,6 +1061,11 @@ if __name__ == "__main__":
     for f in processor.failed:
         print(" - ", f)
 
+    print('-------------------')
+    print("Skipped:")
+    for s in processor.skipped:
+        print(" - ", s)
+
     print('-------------------')
     print("Succesfully generated files for:")
     for s in processor.successful:
@@ -0,0 +1,439 @@
+"""scheduler.py
+
+Cost-model driven scheduling of the MintPy runs.
+
+The runtime of a MintPy run grows roughly with the number of pixels in
+the AOI times the number of interferograms in the stack. A few large
+volcanoes dominate the total runtime, so starting them late, as config
+order tends to do, leaves most workers idle at the end of the run.
+Running many of them at once, on the other hand, can exhaust the
+machine's memory.
+
+The scheduler therefore starts the most expensive pending run first
+(longest processing time first), but only admits a run when its
+estimated memory use fits in the remaining memory budget, filling any
+room left with smaller runs. A run too large for the budget on its own
+is started alone, as soon as the runs ahead of it have finished.
+
+Cost estimates start out as a pixel-interferogram count, and are
+calibrated against the measured core-seconds of every successful run,
+which are kept between runs.
+
+Runs and the workers within each run share one budget of CPU cores.
+While more runs may still be added, every run gets a single core, so
+as many volcanoes as possible run side by side. Once all runs are
+known, each run started gets a share of the free cores in proportion
+to its part of the remaining estimated work. Cores left free, and
+those the finished runs free up, are handed to the runs still going,
+again in proportion to their remaining work. A run's cores are held in
+a shared integer that it reads before each MintPy step, so the large
+runs left at the end pick up the cores the finished ones free up,
+rather than processing on one core while the rest sit idle.
+
+Classes
+-------
+CostModel
+    Runtime and memory estimates of MintPy runs, learned from past runs
+Scheduler
+    Memory-aware, largest-first admission of tasks to an executor
+
+Functions
+---------
+task_size(proj_downloads, volcano, footprints)
+    Return the AOI pixel count and interferogram count of a volcano
+"""
+
+import json
+import multiprocessing
+import os
+import statistics
+import threading
+import time
+
+from pathlib import Path
+
+from osgeo import gdal
+
+try:
+    # When run as a module
+    from .footprints import FootprintIndex, aoi_bounds
+except ImportError:
+    # When run as a script
+    from footprints import FootprintIndex, aoi_bounds
+
+# Core-seconds per pixel per interferogram, used until there is any
+# history
+DEFAULT_RATE = 2e-6
+
+# Rough memory use of a MintPy run: a fixed overhead, plus the bytes held
+# per pixel per interferogram (phase, coherence and a working copy, as
+# float32). MintPy processes large stacks in blocks of its maxMemory, so
+# the second part is capped at that.
+BASE_MEMORY = 1024**3
+BYTES_PER_VALUE = 12
+
+# Weight of the latest run when updating a volcano's runtime rate
+SMOOTHING = 0.5
+
+
+def task_size(proj_downloads: Path, volcano, footprints: FootprintIndex) -> tuple:
+    """Return the AOI pixel count and interferogram count of a volcano
+
+    Parameters
+    ----------
+    proj_downloads : Path
+        The directory holding the downloaded product directories
+    volcano : VolcanoArea
+        The volcano to size
+    footprints : FootprintIndex
+        Footprints of the products in proj_downloads
+
+    Returns
+    -------
+    pixels : int
+        The number of pixels in the AOI
+    n_ifgs : int
+        The number of interferograms that cover the AOI
+    """
+    unw_files = [
+        product_dir / f"{product_dir.name}_unw_phase.tif"
+        for product_dir in proj_downloads.iterdir()
+        if product_dir.name not in volcano.filter_dates
+    ]
+    unw_files = [
+        f for f in unw_files
+        if f.exists() and footprints.intersects(f, volcano.ul, volcano.lr)
+    ]
+    if not unw_files:
+        return (0, 0)
+
+    ds = gdal.Open(str(unw_files[0]))
+    gt = ds.GetGeoTransform()
+    ds = None
+
+    minx, miny, maxx, maxy = aoi_bounds(volcano.ul, volcano.lr)
+    pixels = int((maxx - minx) / abs(gt[1])) * int((maxy - miny) / abs(gt[5]))
+    return (pixels, len(unw_files))
+
+
+class CostModel:
+    """Runtime and memory estimates of MintPy runs, learned from past runs
+
+    Each volcano's runtime is stored as a rate, in core-seconds per pixel
+    per interferogram, so estimates follow the growth of its stack and
+    don't depend on the cores a run happened to get. Volcanoes without
+    any history use the median rate of all others.
+
+    Attributes
+    ----------
+    history_file : Path
+        The file the runtime history is kept in
+    max_memory : int or None
+        The memory MintPy processes blocks of, in bytes (its
+        mintpy.compute.maxMemory). None for no cap on the estimates.
+
+    Methods
+    -------
+    estimate(key, pixels, n_ifgs)
+        Return the estimated runtime and memory use of a run
+    record(key, pixels, n_ifgs, core_seconds)
+        Record the measured runtime of a successful run
+    save()
+        Write the history to disk
+    """
+
+    def __init__(self, history_file: Path, max_memory: int | None = None):
+        """
+        Parameters
+        ----------
+        history_file : Path
+            The file the runtime history is kept in
+        max_memory : int, optional
+            The memory MintPy processes blocks of, in bytes (default:
+            None, no cap on the estimates)
+        """
+        self.history_file = Path(history_file)
+        self.max_memory = max_memory
+        try:
+            self._history = json.loads(self.history_file.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._history = {}
+
+        self._lock = threading.Lock()
+
+    def _rate(self, key: str) -> float:
+        if key in self._history:
+            return self._history[key]['rate']
+        if self._history:
+            return statistics.median(entry['rate'] for entry in self._history.values())
+        return DEFAULT_RATE
+
+    def estimate(self, key: str, pixels: int, n_ifgs: int) -> tuple:
+        """Return the estimated runtime and memory use of a run
+
+        Parameters
+        ----------
+        key : str
+            The volcano's key, e.g. its processing directory name
+        pixels : int
+            The number of pixels in the AOI
+        n_ifgs : int
+            The number of interferograms in the stack
+
+        Returns
+        -------
+        core_seconds : float
+            The estimated runtime, times the cores used
+        memory : int
+            The estimated peak memory use, in bytes
+        """
+        units = pixels * n_ifgs
+        with self._lock:
+            core_seconds = self._rate(key) * units
+        data_memory = BYTES_PER_VALUE * units
+        if self.max_memory is not None:
+            data_memory = min(data_memory, self.max_memory)
+        return (core_seconds, BASE_MEMORY + data_memory)
+
+    def record(self, key: str, pixels: int, n_ifgs: int, core_seconds: float) -> None:
+        """Record the measured runtime of a successful run
+
+        Parameters
+        ----------
+        key : str
+            The volcano's key
+        pixels : int
+            The number of pixels in the AOI
+        n_ifgs : int
+            The number of interferograms in the stack
+        core_seconds : float
+            The measured runtime, times the cores used
+        """
+        units = pixels * n_ifgs
+        if units <= 0:
+            return
+
+        rate = core_seconds / units
+        with self._lock:
+            entry = self._history.get(key)
+            if entry is not None:
+                rate = SMOOTHING * rate + (1 - SMOOTHING) * entry['rate']
+            self._history[key] = {'rate': rate, 'pixels': pixels, 'n_ifgs': n_ifgs}
+
+    def save(self) -> None:
+        """Write the history to disk"""
+        with self._lock:
+            self.history_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.history_file.with_suffix('.tmp')
+            tmp_file.write_text(json.dumps(self._history, indent=1))
+            os.replace(tmp_file, self.history_file)
+
+
+class Scheduler:
+    """Memory-aware, largest-first admission of tasks to an executor
+
+    Tasks are added with their estimated cost and memory use, and only
+    submitted to the executor by dispatch(). Call dispatch() again
+    whenever a task has been added or has finished.
+
+    Attributes
+    ----------
+    executor : Executor
+        The executor to run the tasks on. It should have at least as many
+        workers as there are cores.
+    cores : int
+        The number of cores shared by all running tasks
+    memory_budget : int
+        The memory available to all running tasks together, in bytes
+
+    Methods
+    -------
+    add(key, cost, memory, fn, *args, **kwargs)
+        Add a task to be run
+    close()
+        Mark that no more tasks will be added
+    dispatch()
+        Submit as many pending tasks as the budget allows
+    running()
+        Return the futures of the running tasks
+    finish(future)
+        Release the resources of a finished task
+    """
+
+    def __init__(self, executor, cores: int, memory_budget: int):
+        """
+        Parameters
+        ----------
+        executor : Executor
+            The executor to run the tasks on
+        cores : int
+            The number of cores shared by all running tasks
+        memory_budget : int
+            The memory available to all running tasks together, in bytes
+        """
+        self.executor = executor
+        self.cores = cores
+        self.memory_budget = memory_budget
+
+        self._pending = []
+        self._running = {}
+        self._closed = False
+
+    def __bool__(self) -> bool:
+        """True while any task is pending or running"""
+        return bool(self._pending or self._running)
+
+    def add(self, key, cost: float, memory: int, fn, *args, **kwargs) -> None:
+        """Add a task to be run
+
+        Parameters
+        ----------
+        key
+            Identifies the task in the result of finish()
+        cost : float
+            The estimated runtime of the task, in core-seconds
+        memory : int
+            The estimated memory use of the task, in bytes
+        fn : callable
+            The function to run, followed by its arguments. It is also
+            passed the number of cores it may use, as the cores keyword
+            argument: a shared integer (a multiprocessing Value) that
+            only ever grows while it runs, as cores are freed up. It
+            should read the value again before each parallel step.
+        """
+        self._pending.append((cost, memory, key, fn, args, kwargs))
+        self._pending.sort(key=lambda task: task[0], reverse=True)
+
+    def close(self) -> None:
+        """Mark that no more tasks will be added, so the remaining
+        tasks can be given more than one core"""
+        self._closed = True
+
+    def _in_use(self) -> int:
+        return sum(run['cores'].value for run in self._running.values())
+
+    def _set_cores(self, run: dict, cores: int) -> None:
+        """Change the cores of a running task, adding up its core-seconds
+        so far"""
+        now = time.monotonic()
+        run['core_seconds'] += (now - run['changed']) * run['cores'].value
+        run['changed'] = now
+        run['cores'].value = cores
+
+    def dispatch(self) -> list:
+        """Submit as many pending tasks as the budget allows
+
+        Once no more tasks will be added, any cores left free are then
+        handed to the running tasks.
+
+        Returns
+        -------
+        list
+            The keys of the tasks submitted
+        """
+        submitted = []
+        while self._pending:
+            free = self.cores - self._in_use()
+            if free < 1:
+                break
+
+            in_use = sum(run['memory'] for run in self._running.values())
+            if self._pending[0][1] > self.memory_budget:
+                # The most expensive task is too large for the budget, so
+                # it runs on its own, as soon as the running tasks finish.
+                if self._running:
+                    break
+                task = self._pending[0]
+            else:
+                task = next(
+                    (t for t in self._pending if in_use + t[1] <= self.memory_budget),
+                    None
+                )
+                if task is None:
+                    break
+
+            cost, memory, key, fn, args, kwargs = task
+            if not self._closed:
+                cores = 1
+            elif memory > self.memory_budget:
+                # Running alone
+                cores = free
+            else:
+                pending_cost = sum(t[0] for t in self._pending)
+                share = round(free * cost / pending_cost) if pending_cost > 0 else 1
+                cores = min(max(share, 1), free)
+
+            self._pending.remove(task)
+            # No lock, so it can be passed to processes of any start method
+            shared = multiprocessing.Value('i', cores, lock=False)
+            future = self.executor.submit(fn, *args, cores=shared, **kwargs)
+            now = time.monotonic()
+            self._running[future] = {
+                'key': key,
+                'memory': memory,
+                'cost': cost,
+                'cores': shared,
+                'start': now,
+                'changed': now,
+                'core_seconds': 0.,
+            }
+            submitted.append(key)
+
+        if self._closed:
+            self._spread()
+        return submitted
+
+    def _spread(self) -> None:
+        """Hand the free cores to the running tasks, in proportion to
+        their estimated remaining cost"""
+        free = self.cores - self._in_use()
+        if free < 1 or not self._running:
+            return
+
+        now = time.monotonic()
+        remaining = {}
+        for future, run in self._running.items():
+            used = run['core_seconds'] + (now - run['changed']) * run['cores'].value
+            remaining[future] = max(run['cost'] - used, 0.)
+        total = sum(remaining.values())
+        if total > 0:
+            shares = {future: free * cost / total for future, cost in remaining.items()}
+        else:
+            shares = {future: free / len(remaining) for future in remaining}
+
+        # Whole cores, the ones left over going to the largest remainders
+        extra = {future: int(share) for future, share in shares.items()}
+        left = free - sum(extra.values())
+        for future in sorted(shares, key=lambda f: shares[f] - extra[f], reverse=True)[:left]:
+            extra[future] += 1
+
+        for future, cores in extra.items():
+            if cores:
+                run = self._running[future]
+                self._set_cores(run, run['cores'].value + cores)
+
+    def running(self) -> set:
+        """Return the futures of the running tasks"""
+        return set(self._running)
+
+    def finish(self, future) -> tuple:
+        """Release the resources of a finished task
+
+        Parameters
+        ----------
+        future : Future
+            A future returned by running(), that is done
+
+        Returns
+        -------
+        key
+            The key the task was added with
+        elapsed : float
+            The time since the task was submitted, in seconds
+        core_seconds : float
+            The time since the task was submitted, times the cores it
+            had over that time
+        """
+        run = self._running.pop(future)
+        self._set_cores(run, run['cores'].value)
+        return (run['key'], time.monotonic() - run['start'], run['core_seconds'])
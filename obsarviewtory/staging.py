@@ -0,0 +1,127 @@
+"""staging.py
+
+Stages downloaded project files into per-volcano analysis directories.
+
+Rather than copying the whole project download for every volcano,
+only the product types needed for processing are brought in, and each
+file is linked rather than copied. A hardlink is used where possible,
+then a reflink (copy-on-write clone), then a symlink, falling back to a
+real copy only if the filesystem supports none of these.
+
+Staged files share their data with the download cache, so they must
+only ever be read or unlinked, never modified in place.
+
+Functions
+---------
+link_file(src, dst)
+    Link a single file into place, returning the method used
+stage_project(proj_downloads, analysis_directory, filter_dates, suffixes)
+    Stage the needed files of a project download into an analysis
+    directory
+"""
+
+import fcntl
+import os
+import shutil
+
+from pathlib import Path
+
+# Linux ioctl to clone a file's extents (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def _reflink(src: Path, dst: Path) -> None:
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            dst.unlink()
+            raise
+
+
+def link_file(src: Path, dst: Path) -> str:
+    """Link a single file into place, returning the method used
+
+    Parameters
+    ----------
+    src : Path
+        The file to link to
+    dst : Path
+        The location of the new link. Any existing file is replaced.
+
+    Returns
+    -------
+    str
+        One of 'hardlink', 'reflink', 'symlink' or 'copy'
+    """
+    dst.unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+        return 'hardlink'
+    except OSError:
+        pass
+
+    try:
+        _reflink(src, dst)
+        return 'reflink'
+    except OSError:
+        pass
+
+    try:
+        dst.symlink_to(src.resolve())
+        return 'symlink'
+    except OSError:
+        pass
+
+    shutil.copy2(src, dst)
+    return 'copy'
+
+
+def stage_project(
+        proj_downloads: Path,
+        analysis_directory: Path,
+        filter_dates: list,
+        suffixes: tuple) -> int:
+    """Stage the needed files of a project download into an analysis
+    directory
+
+    Product directories are recreated as real directories in the
+    analysis directory, so new files (e.g. cropped images) can be
+    written next to the staged ones without touching the download.
+
+    Parameters
+    ----------
+    proj_downloads : Path
+        The directory holding the downloaded product directories
+    analysis_directory : Path
+        The directory to stage the files into
+    filter_dates : list
+        Product names to leave out, as VolcanoArea.filter_dates
+    suffixes : tuple
+        File name endings of the files to stage
+
+    Returns
+    -------
+    int
+        The number of files staged
+    """
+    filter_dates = set(filter_dates)
+    methods = {}
+    for product_dir in proj_downloads.glob('*'):
+        if not product_dir.is_dir() or product_dir.name in filter_dates:
+            continue
+
+        files = [f for f in product_dir.iterdir() if f.name.endswith(suffixes)]
+        if not files:
+            continue
+
+        dest_dir = analysis_directory / product_dir.name
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        for f in files:
+            method = link_file(f, dest_dir / f.name)
+            methods[method] = methods.get(method, 0) + 1
+
+    summary = ', '.join(f"{count} {method}" for method, count in methods.items())
+    print(f"Staged files into {analysis_directory}: {summary or 'none'}")
+    return sum(methods.values())
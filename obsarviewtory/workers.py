@@ -0,0 +1,249 @@
+"""workers.py
+
+Supervised worker processes with per-task and per-stage time limits.
+
+A MintPy run can hang, e.g. waiting on a weather data request that
+never completes. In a process pool such a run holds its worker
+forever, and the whole run waits on it. Instead, every task here runs
+in a fresh process of its own, in its own process group, watched by a
+thread of the parent. Tasks report the stage they are in with
+report_stage(). When a task runs over its total time limit, or over
+the limit of its current stage, its whole process group (including any
+Dask workers it started) is killed, and its future fails with a
+TaskTimeout naming the stage. As every task gets a new process, a
+killed worker is never reused.
+
+Task processes are started by a fork server rather than forked from the
+parent, which runs download, crop and GDAL threads at the same time. A
+child forked while one of those holds a lock (e.g. inside GDAL) could
+hang on its first call that needs it. The task's function and arguments
+must therefore be picklable.
+
+Classes
+-------
+TaskExecutor
+    Executor running each task in a supervised process of its own
+TaskTimeout
+    Raised for a task killed for running over a time limit
+
+Functions
+---------
+report_stage(stage)
+    Report the stage the current task has reached
+current_stage()
+    Return the last stage reported by the current task
+"""
+
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+from concurrent.futures import Future
+
+# Starts the task processes, single threaded, so no lock is held at fork
+_context = multiprocessing.get_context('forkserver')
+
+# The connection to the supervising parent, in a task's process
+_conn = None
+
+# The last stage reported in this process
+_stage = None
+
+
+class TaskTimeout(TimeoutError):
+    """Raised for a task killed for running over a time limit"""
+
+    def __init__(self, stage: str, limit: float):
+        self.stage = stage
+        self.limit = limit
+        super().__init__(f"Timed out after {limit:g} seconds in stage {stage}")
+
+
+def report_stage(stage: str) -> None:
+    """Report the stage the current task has reached
+
+    Restarts the stage time limit. Outside of a TaskExecutor task, the
+    stage is only recorded for current_stage().
+
+    Parameters
+    ----------
+    stage : str
+        The name of the stage
+    """
+    global _stage
+    _stage = stage
+    if _conn is not None:
+        _conn.send(('stage', stage))
+
+
+def current_stage() -> str | None:
+    """Return the last stage reported by the current task"""
+    return _stage
+
+
+def _run(conn, fn, args, kwargs) -> None:
+    """Entry point of a task's process"""
+    global _conn
+    # Own process group, so the task can be killed along with anything
+    # it starts
+    os.setsid()
+    _conn = conn
+    try:
+        result = fn(*args, **kwargs)
+    except BaseException as e:
+        try:
+            conn.send(('error', e))
+        except Exception:
+            # The exception could not be pickled
+            conn.send(('error', RuntimeError(repr(e))))
+    else:
+        conn.send(('result', result))
+    finally:
+        conn.close()
+
+
+class TaskExecutor:
+    """Executor running each task in a supervised process of its own
+
+    Only submit() is supported. Concurrency is left to the caller.
+
+    Attributes
+    ----------
+    task_timeout : float or None
+        The time limit of a whole task, in seconds. None for no limit.
+    stage_timeout : float or None
+        The time limit of a stage, for stages not in stage_timeouts
+    stage_timeouts : dict
+        Time limits of specific stages, by stage name
+
+    Methods
+    -------
+    submit(fn, *args, **kwargs)
+        Run fn(*args, **kwargs) in a new process
+    shutdown(wait)
+        Wait for the running tasks to finish
+    """
+
+    def __init__(
+            self,
+            task_timeout: float | None = None,
+            stage_timeout: float | None = None,
+            stage_timeouts: dict | None = None):
+        """
+        Parameters
+        ----------
+        task_timeout : float, optional
+            The time limit of a whole task, in seconds (default: None,
+            no limit)
+        stage_timeout : float, optional
+            The time limit of a stage, for stages not in stage_timeouts
+            (default: None, no limit)
+        stage_timeouts : dict, optional
+            Time limits of specific stages, by stage name (default: None)
+        """
+        self.task_timeout = task_timeout
+        self.stage_timeout = stage_timeout
+        self.stage_timeouts = stage_timeouts or {}
+        self._threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """Run fn(*args, **kwargs) in a new process
+
+        Returns
+        -------
+        Future
+            Holds the return value of fn, or the exception it raised. A
+            task killed for running over a time limit fails with
+            TaskTimeout, and one whose process died with a RuntimeError.
+        """
+        future = Future()
+        future.set_running_or_notify_cancel()
+        thread = threading.Thread(
+            target=self._supervise,
+            args=(future, fn, args, kwargs),
+            name='task-supervisor',
+            daemon=True
+        )
+        thread.start()
+        self._threads.append(thread)
+        return future
+
+    def _limit(self, stage: str) -> float | None:
+        return self.stage_timeouts.get(stage, self.stage_timeout)
+
+    def _supervise(self, future: Future, fn, args, kwargs) -> None:
+        parent_conn, child_conn = _context.Pipe(duplex=False)
+        proc = _context.Process(target=_run, args=(child_conn, fn, args, kwargs))
+        proc.start()
+        child_conn.close()
+
+        stage = 'starting'
+        start = stage_start = time.monotonic()
+        try:
+            while True:
+                deadlines = []
+                if self.task_timeout is not None:
+                    deadlines.append((start + self.task_timeout, self.task_timeout))
+                stage_limit = self._limit(stage)
+                if stage_limit is not None:
+                    deadlines.append((stage_start + stage_limit, stage_limit))
+                deadline, limit = min(deadlines) if deadlines else (None, None)
+
+                timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                if not parent_conn.poll(timeout):
+                    self._kill(proc)
+                    future.set_exception(TaskTimeout(stage, limit))
+                    return
+
+                try:
+                    kind, value = parent_conn.recv()
+                except EOFError:
+                    proc.join()
+                    future.set_exception(RuntimeError(
+                        f"Worker exited with code {proc.exitcode} in stage {stage}"
+                    ))
+                    return
+
+                if kind == 'stage':
+                    stage = value
+                    stage_start = time.monotonic()
+                elif kind == 'result':
+                    future.set_result(value)
+                    return
+                else:
+                    future.set_exception(value)
+                    return
+        finally:
+            parent_conn.close()
+            proc.join()
+
+    @staticmethod
+    def _kill(proc: multiprocessing.Process) -> None:
+        """Kill a task's process group"""
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        # In case it was killed before it got its own process group
+        proc.kill()
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Wait for the running tasks to finish
+
+        Parameters
+        ----------
+        wait : bool, optional
+            Wait for the tasks. If False, return at once (default: True)
+        """
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
@@ -0,0 +1,7 @@
+import sys
+
+from pathlib import Path
+
+# Import the modules the way the scripts do, without the package
+# __init__, which needs the full MintPy environment.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'obsarviewtory'))
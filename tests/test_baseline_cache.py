@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import baseline_cache
+
+
+def _jittered_stack():
+    """Seven scenes 12 days apart, alternately 2 s earlier and later in
+    the day than the newest one"""
+    start = pd.Timestamp('2023-01-01T16:49:52', tz='UTC')
+    times = [
+        start + pd.Timedelta(days=12 * i, seconds=-2 if i % 2 else 2)
+        for i in range(7)
+    ]
+    names = [f"S{i}" for i in range(7)]
+    return baseline_cache._frame(names, times)
+
+
+def test_frame_baselines_are_whole_days():
+    stack = _jittered_stack()
+    assert list(stack.temporalBaseline) == [-72, -60, -48, -36, -24, -12, 0]
+
+
+def test_frame_orders_and_deduplicates():
+    stack = baseline_cache._frame(
+        ['B', 'A', 'B'],
+        ['2023-01-13T00:00:00Z', '2023-01-01T00:00:00Z', '2023-01-13T00:00:00Z']
+    )
+    assert list(stack.sceneName) == ['A', 'B']
+    assert isinstance(stack.index, pd.RangeIndex)
+
+
+def test_sbas_pairs_keep_48_day_pairs():
+    pytest.importorskip('osgeo')
+    import avo_insar_functions
+
+    stack = _jittered_stack()
+    pairs = avo_insar_functions.avo_insar_sbas_pairs(stack, max_days=48)
+
+    baselines = dict(zip(stack.sceneName, stack.temporalBaseline))
+    expected = {
+        (ref, sec) for ref in baselines for sec in baselines
+        if 0 < baselines[sec] - baselines[ref] <= 48
+    }
+    assert pairs == expected
+    assert ('S0', 'S4') in pairs
+    assert np.all([baselines[sec] > baselines[ref] for ref, sec in pairs])
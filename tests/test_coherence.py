@@ -0,0 +1,99 @@
+import json
+
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+
+import coherence
+
+VOLCANO = SimpleNamespace(volc_name='Test', ul=[-150.1, 60.1], lr=[-150.0, 60.0])
+
+
+def _write_clip(analysis_directory, product, data):
+    """Write a coherence clip in its product directory"""
+    product_dir = analysis_directory / product
+    product_dir.mkdir(parents=True)
+    fname = product_dir / f"{product}{coherence.CORR_SUFFIX}"
+    ds = gdal.GetDriverByName('GTiff').Create(str(fname), data.shape[1], data.shape[0], 1, gdal.GDT_Float32)
+    ds.GetRasterBand(1).WriteArray(data)
+    ds = None
+    return fname
+
+
+def test_summarize_ignores_masked_pixels():
+    data = np.zeros((1, 4, 5), dtype=np.float32)
+    data[0, :2] = 0.8
+    data[0, 2, :2] = 0.1
+
+    mean, fraction = coherence._summarize(data, 0.3)
+    assert mean[0] == pytest.approx((10 * 0.8 + 2 * 0.1) / 12)
+    assert fraction[0] == pytest.approx(10 / 12)
+
+    # Masked pixels are not coherent, whatever the threshold
+    _, fraction = coherence._summarize(data, 0.)
+    assert fraction[0] == 1
+
+
+def test_summarize_threshold_is_inclusive():
+    data = np.full((1, 2, 2), 0.7, dtype=np.float32)
+    data[0, 0, 0] = np.nextafter(np.float32(0.7), np.float32(0))
+
+    _, fraction = coherence._summarize(data, 0.7)
+    assert fraction[0] == pytest.approx(0.75)
+
+
+def test_summarize_no_data():
+    mean, fraction = coherence._summarize(np.zeros((2, 3, 3), dtype=np.float32), 0.3)
+    np.testing.assert_array_equal(mean, 0)
+    np.testing.assert_array_equal(fraction, 0)
+
+
+def test_is_coherent():
+    data = np.zeros((4, 4), dtype=np.float32)
+    data[:2] = 0.5
+    data[2] = 0.2
+
+    assert coherence.is_coherent(data, threshold=0.3, min_mean=0.4, min_fraction=2 / 3)
+    assert not coherence.is_coherent(data, threshold=0.3, min_mean=0.41)
+    assert not coherence.is_coherent(data, threshold=0.3, min_fraction=0.7)
+
+
+def test_screen_removes_and_caches(tmp_path, monkeypatch):
+    analysis_directory = tmp_path / 'analysis'
+    stats_file = tmp_path / 'coherence' / 'Test.json'
+    good = np.full((3, 4), 0.6, dtype=np.float32)
+    poor = np.full((3, 4), 0.1, dtype=np.float32)
+    _write_clip(analysis_directory, 'good', good)
+    _write_clip(analysis_directory, 'poor', poor)
+
+    removed = coherence.screen(analysis_directory, VOLCANO, stats_file, 0.3, 0.2, 0.1)
+    assert removed == ['poor']
+    assert not (analysis_directory / 'poor').exists()
+    state = json.loads(stats_file.read_text())
+    assert set(state['stats']) == {'good', 'poor'}
+
+    # Only the new clip is read on the next run
+    read = []
+    summarize = coherence.coherence_stats
+
+    def coherence_stats(corr_files, threshold):
+        read.extend(f.parent.name for f in corr_files)
+        return summarize(corr_files, threshold)
+
+    monkeypatch.setattr(coherence, 'coherence_stats', coherence_stats)
+    _write_clip(analysis_directory, 'new', good)
+    assert coherence.screen(analysis_directory, VOLCANO, stats_file, 0.3, 0.2, 0.1) == []
+    assert read == ['new']
+
+    # Nothing is read once every clip is known
+    read.clear()
+    assert coherence.screen(analysis_directory, VOLCANO, stats_file, 0.3, 0.2, 0.1) == []
+    assert read == []
+
+    # A new threshold reads them all again
+    assert coherence.screen(analysis_directory, VOLCANO, stats_file, 0.7, 0., 0.5) == ['good', 'new']
+    assert sorted(read) == ['good', 'new']
+    assert json.loads(stats_file.read_text())['threshold'] == 0.7
@@ -0,0 +1,173 @@
+import json
+
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip('h5py')
+ifginv = pytest.importorskip('mintpy.ifgram_inversion')
+
+import incremental_inversion
+
+from mintpy.objects import ifgramStack
+
+DATES = [f"202301{day:02d}" for day in range(1, 25, 3)]
+OLD_DATES = DATES[:6]
+OLD_PAIRS = [
+    (DATES[i], DATES[j]) for i in range(6) for j in range(i + 1, min(i + 3, 6))
+]
+NEW_PAIRS = [
+    (DATES[4], DATES[6]),
+    (DATES[5], DATES[6]),
+    (DATES[5], DATES[7]),
+    (DATES[6], DATES[7]),
+]
+SHAPE = (6, 5)
+REF_YX = (0, 0)
+WAVELENGTH = 0.0555
+
+# Pixels with no data in one new pair, and in every pair of the last date
+PARTIAL_YX = (2, 3)
+EMPTY_YX = (4, 1)
+
+
+def _write_stack(stack_file, phase, coherence, keep):
+    pairs = OLD_PAIRS + NEW_PAIRS
+    with h5py.File(stack_file, 'w') as f:
+        f.create_dataset('date', data=np.array(pairs, dtype=np.bytes_))
+        f.create_dataset('dropIfgram', data=np.array(keep))
+        f.create_dataset('bperp', data=np.linspace(-50, 50, len(pairs)).astype(np.float32))
+        f.create_dataset('unwrapPhase', data=phase.astype(np.float32))
+        f.create_dataset('coherence', data=coherence.astype(np.float32))
+        f.attrs.update({
+            'FILE_TYPE': 'ifgramStack',
+            'LENGTH': SHAPE[0],
+            'WIDTH': SHAPE[1],
+            'WAVELENGTH': WAVELENGTH,
+            'REF_Y': REF_YX[0],
+            'REF_X': REF_YX[1],
+            'ALOOKS': 4,
+            'RLOOKS': 4,
+        })
+
+
+def _full_inversion(stack_file):
+    """MintPy's own inversion of the used pairs of a stack"""
+    stack = ifgramStack(str(stack_file))
+    stack.open(print_msg=False)
+    ref_phase = stack.get_reference_phase(dropIfgram=True)
+    ts, _, tcoh, num, _ = ifginv.run_ifgram_inversion_patch(
+        str(stack_file), ref_phase=ref_phase, weight_func='var')
+    tcoh[REF_YX] = 1
+    num[REF_YX] = len(ref_phase)
+    return ts, tcoh, num, stack.get_date_list(dropIfgram=True)
+
+
+def _write_inversion(directory, ts, tcoh, num, dates):
+    with h5py.File(directory / 'timeseries.h5', 'w') as f:
+        f.create_dataset('date', data=np.array(dates, dtype=np.bytes_))
+        f.create_dataset('bperp', data=np.zeros(len(dates), dtype=np.float32))
+        f.create_dataset('timeseries', data=ts)
+        f.attrs['END_DATE'] = dates[-1]
+    with h5py.File(directory / incremental_inversion.TCOH_NAME, 'w') as f:
+        f.create_dataset('temporalCoherence', data=tcoh)
+    with h5py.File(directory / incremental_inversion.NUM_INV_NAME, 'w') as f:
+        f.create_dataset('mask', data=num.astype(np.float32))
+
+
+@pytest.fixture
+def stack_dir(tmp_path):
+    """A MintPy directory inverted for the old pairs, with new pairs
+    appended to its stack
+
+    The old pairs are noisy, and the new pairs consistent with the old
+    time-series, so a full inversion of all pairs keeps the old dates
+    and must agree with the incremental one.
+    """
+    rng = np.random.default_rng(1)
+    (tmp_path / 'inputs').mkdir()
+    stack_file = tmp_path / 'inputs' / 'ifgramStack.h5'
+    pairs = OLD_PAIRS + NEW_PAIRS
+    offsets = 0.5 + 0.1 * np.arange(len(pairs))
+
+    truth = rng.normal(0, 3, (len(DATES),) + SHAPE)
+    truth[0] = 0
+    truth[:, REF_YX[0], REF_YX[1]] = 0
+    phase = np.zeros((len(pairs),) + SHAPE)
+    for k, (d1, d2) in enumerate(OLD_PAIRS):
+        phase[k] = truth[DATES.index(d2)] - truth[DATES.index(d1)] + offsets[k]
+        phase[k] += rng.normal(0, 0.3, SHAPE)
+    coherence = rng.uniform(0.2, 0.95, phase.shape)
+
+    keep = [True] * len(OLD_PAIRS) + [False] * len(NEW_PAIRS)
+    _write_stack(stack_file, phase, coherence, keep)
+    ts, tcoh, num, dates = _full_inversion(stack_file)
+    _write_inversion(tmp_path, ts, tcoh, num, dates)
+    incremental_inversion.record_full_inversion(tmp_path)
+
+    phase2range = -WAVELENGTH / (4 * np.pi)
+    known = np.concatenate([ts / phase2range, truth[len(OLD_DATES):]])
+    for k, (d1, d2) in enumerate(NEW_PAIRS, start=len(OLD_PAIRS)):
+        phase[k] = known[DATES.index(d2)] - known[DATES.index(d1)] + offsets[k]
+    phase[len(OLD_PAIRS), PARTIAL_YX[0], PARTIAL_YX[1]] = 0
+    for k, pair in enumerate(NEW_PAIRS, start=len(OLD_PAIRS)):
+        if DATES[7] in pair:
+            phase[k, EMPTY_YX[0], EMPTY_YX[1]] = 0
+    _write_stack(stack_file, phase, coherence, [True] * len(pairs))
+    return tmp_path
+
+
+def test_incremental_matches_full_inversion(stack_dir):
+    assert incremental_inversion.invert_new_dates(stack_dir, 30)
+    ts, tcoh, num, dates = _full_inversion(stack_dir / 'inputs' / 'ifgramStack.h5')
+
+    with h5py.File(stack_dir / 'timeseries.h5', 'r') as f:
+        assert [d.decode() for d in f['date'][:]] == dates
+        np.testing.assert_allclose(f['timeseries'][:], ts, atol=1e-5)
+    with h5py.File(stack_dir / incremental_inversion.TCOH_NAME, 'r') as f:
+        np.testing.assert_allclose(f['temporalCoherence'][:], tcoh, atol=1e-4)
+    with h5py.File(stack_dir / incremental_inversion.NUM_INV_NAME, 'r') as f:
+        np.testing.assert_array_equal(f['mask'][:], num)
+
+    state = json.loads((stack_dir / incremental_inversion.STATE_NAME).read_text())
+    assert len(state['pairs']) == len(OLD_PAIRS + NEW_PAIRS)
+
+
+def test_no_data_pixels(stack_dir):
+    assert incremental_inversion.invert_new_dates(stack_dir, 30)
+
+    with h5py.File(stack_dir / 'timeseries.h5', 'r') as f:
+        ts = f['timeseries'][:]
+    with h5py.File(stack_dir / incremental_inversion.NUM_INV_NAME, 'r') as f:
+        num = f['mask'][:]
+
+    # Solved from the remaining pair, without that pair
+    assert np.all(ts[6:, PARTIAL_YX[0], PARTIAL_YX[1]] != 0)
+    assert num[PARTIAL_YX] == len(OLD_PAIRS + NEW_PAIRS) - 1
+
+    # Not solved for the last date, so zeroed, as MintPy does
+    assert np.all(ts[:, EMPTY_YX[0], EMPTY_YX[1]] == 0)
+    assert num[EMPTY_YX] == 0
+
+
+def test_solve_matches_mintpy_weighted_estimate():
+    rng = np.random.default_rng(2)
+    A = np.array([[1, 0], [1, 0], [0, 1], [-1, 1]], dtype=np.float32)
+    obs = rng.normal(0, 2, (4, 50)).astype(np.float32)
+    obs[0, :10] = np.nan
+    obs[2:, 10:15] = np.nan
+    weight_sqrt = rng.uniform(0.5, 3, obs.shape).astype(np.float32)
+
+    x, count = incremental_inversion._solve(A, obs, weight_sqrt)
+
+    for p in range(obs.shape[1]):
+        expected, _, num_obs = ifginv.estimate_timeseries(
+            A, A, obs[:, p], np.ones((2, 1)),
+            weight_sqrt=weight_sqrt[:, p],
+            min_norm_velocity=False,
+            inv_quality_name='no',
+            print_msg=False)
+        np.testing.assert_allclose(x[:, p], expected[1:, 0], rtol=1e-4, atol=1e-5)
+        assert count[p] == num_obs
+
+    # The second date has no data at these pixels
+    assert np.all(x[:, 10:15] == 0) and np.all(count[10:15] == 0)
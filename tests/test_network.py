@@ -0,0 +1,77 @@
+import pandas as pd
+
+import network
+
+
+def _stack(count, days=12):
+    """Acquisitions every days days, named by their date"""
+    dates = pd.date_range('2022-01-01', periods=count, freq=f'{days}D')
+    return pd.DataFrame({
+        'sceneName': dates.strftime('%Y%m%d'),
+        'temporalBaseline': (dates - dates[-1]).days,
+    })
+
+
+def _chain(dates, neighbours=2):
+    """Pairs of each date with its neighbours nearest earlier dates"""
+    return {
+        (dates[i - rank], dates[i])
+        for i in range(len(dates)) for rank in range(1, neighbours + 1) if i >= rank
+    }
+
+
+DATES = list(_stack(8).sceneName)
+
+
+def test_connected_network_passes():
+    assert network.check_network(_chain(DATES)) is None
+
+
+def test_split_network():
+    pairs = _chain(DATES[:4]) | _chain(DATES[4:])
+    reason = network.check_network(pairs)
+    assert reason == f"Network is split into 2 parts, starting {DATES[0]}, {DATES[4]}"
+
+
+def test_too_few_dates():
+    reason = network.check_network({(DATES[0], DATES[1])}, min_dates=3)
+    assert reason == "Only 2 dates in the network (minimum 3)"
+
+
+def test_edge_date_below_min_redundancy():
+    # The last date is only in the pair to its predecessor
+    pairs = _chain(DATES[:-1]) | {(DATES[-2], DATES[-1])}
+    reason = network.check_network(pairs, min_redundancy=2)
+    assert reason == f"1 dates are in fewer than 2 interferograms (first {DATES[-1]})"
+    assert network.check_network(pairs, min_redundancy=1) is None
+
+
+def test_product_pairs():
+    name = 'S1AA_20230101T165952_20230113T165951_VVP012_INT80_G_ueF_6A4B'
+    assert network.product_pairs([name]) == [('20230101', '20230113')]
+
+
+def test_budgeted_nearest_design_keeps_redundancy():
+    # Add the acquisitions of two years one update at a time, with no
+    # budget at all beyond the pairs always kept
+    stack = _stack(60)
+    project = set()
+    for new in range(1, len(stack)):
+        pairs = network.design_pairs(stack.iloc[:new + 1], new, neighbours=3, budget=0, exclude=project)
+        assert len(pairs) <= network.MIN_NEIGHBOURS
+        assert not pairs & project
+        project |= pairs
+
+    assert network.check_network(project, min_dates=3, min_redundancy=2) is None
+
+
+def test_design_budget_ranks_optional_pairs():
+    stack = _stack(40)
+    first_new = 35
+    required, optional = network.nearest_pairs(stack, first_new, neighbours=3)
+    pairs = network.design_pairs(stack, first_new, neighbours=3, budget=len(required) + 1)
+
+    # The newest acquisition's annual bridge comes first
+    bridge = optional[0]
+    assert bridge[1] == stack.sceneName.iloc[-1]
+    assert pairs == set(required) | {bridge}